@@ -13,80 +13,75 @@
 
 import numpy as np
 import argparse as ap
+import os
+import io
 import timeit
+import multiprocessing
 import mdtraj as md
 
-def generateKmesh(_L, _kmax, PosOctant=False, PosOnly=False, SphCut=True):
-    """ Build a k mesh in 3D.
+def generateKmesh(_L, _kmax, PosOctant=False, PosOnly=False, SphCut=True, HalfSpace=False, Normal=None, verbose=True):
+    """ Build a k mesh in 3D, or in the plane normal to one axis.
 
     Notes
     -----
     If i,j,k are integer offsets, we return an array that takes i**2+j**2+k**2 and maps to an index of |k| values 
-    Currently assumes a spherical box
+    _L is the box length, or the three lengths (Lx, Ly, Lz) of an orthorhombic box
+    HalfSpace keeps exactly one of each (k, -k) pair (plus k=0); since S(k) = S(-k) for real densities,
+    each vector then stands for two points of the full mesh, see halfSpaceWeights
+    Normal is the axis (0, 1, 2) normal to the plane of a 2D mesh, along which k is zero (e.g. S(q_xy)
+    of an interface for Normal=2), or None for the 3D mesh
+    verbose prints the mesh spacing and box
     """
 
-    # Define the k grid for cubic cell
-    dk=2*np.pi/_L # We compute the k^2 using integer lattice offsets and this grid spacing
+    # Define the k grid for an orthorhombic cell, one spacing per axis
+    dk=2*np.pi/np.broadcast_to(np.asarray(_L, dtype=np.float64), [3]) # We compute the k^2 using integer lattice offsets and this grid spacing
 
-    print(dk, " ", _L, " ")
+    if verbose:
+      print(dk, " ", _L, " ")
+    ndim = 3 if Normal is None else 2
     if SphCut:
-      nkmax=int((_kmax/dk+1.0)) # +1 because the mesh is zero based = [0, nkmax-1] in each dimension
+      nkmax=(_kmax/dk+1.0).astype(int) # +1 because the mesh is zero based = [0, nkmax-1] in each dimension
     else:
-      nkmax=int((_kmax/dk+1.0)/np.sqrt(3)) # +1 because the mesh is zero based = [0, nkmax-1] in each dimension; 1/sqrt(3) approximately makes the body diaganal of the mesh ~kmax
+      nkmax=((_kmax/dk+1.0)/np.sqrt(ndim)).astype(int) # +1 because the mesh is zero based = [0, nkmax-1] in each dimension; 1/sqrt(ndim) approximately makes the body diaganal of the mesh ~kmax
+    if Normal is not None:
+      nkmax[Normal] = 1 # only k=0 normal to the plane
 
-    # Is it better to use mgrid here?
-#    for i in range(-nkmax+1,nkmax):
-#        for j in range(-nkmax+1,nkmax):
-#            for k in range(-nkmax+1,nkmax):
-
-    klist3D=np.empty([(2*nkmax)**3,3])
-    modklist=np.empty([(2*nkmax)**3])
-    kvec=np.empty([3])
-    ik=0
+    # Integer offsets along each axis; indexing='ij' keeps the i-outer, k-inner ordering of the mesh
+    full = [np.arange(-n+1,n) for n in nkmax]
+    pos = [np.arange(n) for n in nkmax]
     if PosOctant == True:
-      for i in range(nkmax):
-        kvec[0] = i*dk
-        for j in range(nkmax):
-          kvec[1] = j*dk
-          for k in range(nkmax):
-            kvec[2] = k*dk
-            modk = np.linalg.norm(kvec)
-            if not SphCut or modk < _kmax:
-              klist3D[ik] = kvec
-              modklist[ik] = modk
-              ik += 1
+      irange, jrange, krange = pos
     elif PosOnly == True:
-      for i in range(-nkmax+1,nkmax):
-        kvec[0] = i*dk
-        for j in range(-nkmax+1,nkmax):
-          kvec[1] = j*dk
-          for k in range(nkmax):
-            kvec[2] = k*dk
-            modk = np.linalg.norm(kvec)
-            if not SphCut or modk < _kmax:
-              klist3D[ik] = kvec
-              modklist[ik] = modk
-              ik += 1
+      irange, jrange, krange = full[0], full[1], pos[2]
+    elif HalfSpace == True:
+      irange, jrange, krange = pos[0], full[1], full[2]
     else:
-      for i in range(-nkmax+1,nkmax):
-        kvec[0] = i*dk
-        for j in range(-nkmax+1,nkmax):
-          kvec[1] = j*dk
-          for k in range(-nkmax+1,nkmax):
-            kvec[2] = k*dk
-            modk = np.linalg.norm(kvec)
-            if not SphCut or modk < _kmax:
-              klist3D[ik] = kvec
-              modklist[ik] = modk
-              ik += 1
-
-    klist3D = np.resize(klist3D,(ik,3))
-    modklist = np.resize(modklist,(ik))
+      irange, jrange, krange = full
+    ii, jj, kk = np.meshgrid(irange, jrange, krange, indexing='ij')
+    offsets = np.stack([ii.ravel(), jj.ravel(), kk.ravel()], axis=1)
+    if HalfSpace == True and PosOctant != True and PosOnly != True:
+      # keep one of each (k, -k) pair: i > 0, or i = 0 and j > 0, or i = j = 0 and k >= 0
+      i, j, k = offsets[:,0], offsets[:,1], offsets[:,2]
+      offsets = offsets[(i > 0) | ((i == 0) & ((j > 0) | ((j == 0) & (k >= 0))))]
+
+    klist3D = offsets*dk
+    # row-wise dot products use the same reduction as np.linalg.norm on each vector, so |k| is bit-identical
+    modklist = np.sqrt(np.matmul(klist3D[:,None,:], klist3D[:,:,None])[:,0,0])
+    if SphCut:
+      keep = modklist < _kmax
+      klist3D = klist3D[keep]
+      modklist = modklist[keep]
+    ik = len(modklist)
 
     return klist3D, modklist, ik
 
 
-def histogrammapping(mesh, modveclist, debug=False):
+def halfSpaceWeights(mesh):
+  """ Number of full-mesh points each vector of a half-space mesh stands for: 1 for k=0, 2 for the (k, -k) pairs """
+  return np.where(np.all(np.asarray(mesh) == 0, axis=1), 1, 2)
+
+
+def histogrammapping(mesh, modveclist, weights=None, debug=False):
   """ Sorts kvectors by magnitude and figures out how many vectors map to said magnitude
   
   Parameters
@@ -95,13 +90,15 @@ def histogrammapping(mesh, modveclist, debug=False):
       numpy array of one index, each entry containing an ndim vec
   modveclist
       numpy array of vector magnitudes
+  weights : nparray
+      number of full-mesh points each vector stands for (see halfSpaceWeights), default 1
   debug : bool
       whether or not to print debugging info
 
   Returns
   -------
   nparray
-      histmapper, 3d mesh index, mapping to the 1d mesh index
+      histmapper, sorted 3d mesh index, mapping to the 1d mesh index
   nparray
       histabcissae, 1d index, returning the magnitude of the sampled k-vectors
   nparray
@@ -109,56 +106,27 @@ def histogrammapping(mesh, modveclist, debug=False):
   int
       index, indices that sort the vector magnitude list
   nparray
-      orderedVecList, same indices as histabcissae, the vectors that map to each k-vec-magnitude
+      shellstart, inverted map: the 3d mesh points of shell abidx are index[shellstart[abidx]:shellstart[abidx+1]]
   """
   # mesh is a numpy array of one index, each entry containing an ndim vec
   # Prepare for histogramming
   nmesh = len(mesh)
+  if weights is None:
+    weights = np.ones(nmesh, dtype=int)
+  weights = np.asarray(weights)
   # Sort by vector magnitudes
   index = np.argsort(modveclist)
-  #
-  # Mapping storage
-  histmapper=[] # Argument = 3d mesh index, return 1d mesh index
-  histabcissae=[] # Argument = 1d mesh index, return |vec|
-  histndegen=[]   # Argument = 1d mesh index, return # 3d points that map to |vec|
-  
-  orderedVecList=[]
+  sortedmod = np.asarray(modveclist)[index]
   #
   GRIDTOL = 1.e-6 #make fine so that code can figure out *distinct* k-magnitudes
-  # Start the mapping
-  previous=modveclist[index[0]]
-  histabcissae.append(previous)
-  histmapper.append(0)
-  histndegen.append(1)
-
-  orderedVecList.append([])
-  orderedVecList[-1].append(mesh[index[0]])
-
-  abidx = 0
-  for ik in range(1,nmesh):
-    current = modveclist[index[ik]]
-    if previous < current-GRIDTOL or previous > current+GRIDTOL:
-      # New |k| entry
-      histabcissae.append(current)
-      histndegen.append(0)
-      orderedVecList.append([])
-      abidx += 1
-    histmapper.append(abidx)
-    histndegen[abidx] += 1
-    orderedVecList[abidx].append(mesh[index[ik]])
-    previous = current
-
-#  j=0
-#  for i in range(len(k2list3D)):
-#      k2=k2list3D[j]
-#      degen=k2list3D.count(k2)
-#      #print i,k2,degen
-#      k2uniqueset.append(k2*dk*dk)
-#      k2degen.append(degen*0.5/_L**3) # Weight = 0.5/V * degeneracy
-#      j=j+degen
-#      if j>=len(k2list3D):
-#          break
-
+  # A new |k| entry starts wherever consecutive sorted magnitudes differ by more than GRIDTOL
+  previous = sortedmod[:-1]
+  current = sortedmod[1:]
+  newentry = (previous < current-GRIDTOL) | (previous > current+GRIDTOL)
+  histmapper = np.concatenate([[0], np.cumsum(newentry)]) # Argument = sorted 3d mesh index, return 1d mesh index
+  shellstart = np.concatenate([[0], np.flatnonzero(newentry)+1, [nmesh]])
+  histabcissae = sortedmod[shellstart[:-1]] # Argument = 1d mesh index, return |vec|
+  histndegen = np.bincount(histmapper, weights=weights[index]).astype(weights.dtype) # Argument = 1d mesh index, return # 3d points that map to |vec|
 
   # === debug ===
   if debug:
@@ -170,33 +138,41 @@ def histogrammapping(mesh, modveclist, debug=False):
     for abidx in range(len(histabcissae)):
         print( abidx,histabcissae[abidx],histndegen[abidx] )
 
-    '''
-    print("\n\n\nOrderedVecList")
-    for vlist in orderedVecList:
-        print(vlist)
-        print("\n")
-    '''
     for abidx in range(len(histabcissae)):
-        print( abidx, histndegen[abidx], len(orderedVecList[abidx]) )
+        print( abidx, histndegen[abidx], shellstart[abidx+1]-shellstart[abidx] )
 
 
   # === return ===
-  return np.array(histmapper), np.array(histabcissae), np.array(histndegen), index, np.array(orderedVecList)
+  return histmapper, histabcissae, histndegen, index, shellstart
 
 
-def pruneKmesh(kmesh3d,modklist,resolution=0.25,n_per_bin=50,debug=False):
+def pruneKmesh(kmesh3d,modklist,resolution=0.25,n_per_bin=50,weights=None,seed=0,debug=False,verbose=True):
   """ Prune the Kmesh by resolution
+
+  Wave vectors are grouped in |k| bins of width resolution; bins holding more than n_per_bin vectors
+  are thinned by stratified random sampling: every |k| shell of the bin keeps a share of n_per_bin
+  proportional to its size, and at least one vector. The kept vectors of a shell are reweighted so
+  that the shell keeps its full degeneracy, and since they are a uniform sample of the shell its
+  average stays unbiased.
   
   Parameters
   ----------
   resolution : float
-      the minimum bin size we want to resolve with at least 100 points per bin
+      width of the |k| bins
+  n_per_bin : int
+      target number of vectors in each bin
   kmesh3d
       the original kmesh
   modklist
       the magnitudes of the kvecs
+  weights : nparray
+      number of full-mesh points each vector stands for (see halfSpaceWeights), default 1
+  seed : int
+      seed of the random sampling, so that the pruned mesh is reproducible
   debug : bool
       whether or not to print debugging reports
+  verbose : bool
+      whether or not to print how many vectors were kept
 
   Returns
   -------
@@ -206,152 +182,1123 @@ def pruneKmesh(kmesh3d,modklist,resolution=0.25,n_per_bin=50,debug=False):
       the new modklist
   new_nk3d : int
       the new nk3d
+  new_weights
+      the (fractional) weights of the kept vectors
   """
 
   # First generate histogram mapping
-  histmapper, histabcissae, histndegen, sortindex3d, orderedVecList = histogrammapping(kmesh3d, modklist, debug=debug)
-
-  flatten = lambda l: [item for sublist in l for item in sublist]
-  bintol = 1.2
-
-  # Iterate through bins 
-  ibin = 0       #current bin's index
-  current = 0    #current bin's lower cutoff
-  bins = []      #a list of the cut-off points we use in the binning process
-  binvecs = []   #temporary list of vectors in current bin
-  finalmesh = [] #vectors that we keep in the final mesh
-  bins.append(0)
-  for ia,ab in enumerate(histabcissae):
-      if ab > current + resolution: #new bin detected
-          # prune current bin if needed
-          n_in_bin = len(binvecs)
-          if n_in_bin > n_per_bin:
-              print("{} vecs in current bin ({},{}), pruning down to {}".format(n_in_bin, current, ab, n_per_bin))
-              inds2keep= np.random.choice(n_in_bin, n_per_bin, replace=False)
-              if debug:
-                  print(inds2keep)
-              binvecs = np.array(binvecs)
-              binvecs = binvecs[list(inds2keep),:]
-
-          # start new bin
-          finalmesh.extend(binvecs)
-          if (ab-current)/resolution > bintol:
-              current = ab
-          else:
-              current = current + resolution
-          bins.append(current)
-          binvecs = []
-          ibin += 1
-      binvecs.extend(orderedVecList[ia])
+  kmesh3d = np.asarray(kmesh3d)
+  modklist = np.asarray(modklist)
+  nk3d = len(kmesh3d)
+  if weights is None:
+    weights = np.ones(nk3d, dtype=int)
+  histmapper, histabcissae, histndegen, sortindex3d, shellstart = histogrammapping(kmesh3d, modklist, weights=weights, debug=debug)
+  nshell = len(histabcissae)
+  shellsize = np.diff(shellstart)
+
+  # Share of each |k| bin that every shell of the bin keeps
+  shellbin = np.floor(histabcissae/resolution).astype(int)
+  binsize = np.bincount(shellbin, weights=shellsize)
+  keepfrac = np.minimum(1., n_per_bin/np.maximum(binsize, 1.))
+  nkeep = np.maximum(np.rint(shellsize*keepfrac[shellbin]), 1).astype(int)
+
+  # Keep the nkeep[s] vectors of shell s with the smallest random keys
+  rng = np.random.default_rng(seed)
+  shell = np.empty(nk3d, dtype=int)
+  shell[sortindex3d] = histmapper
+  order = np.lexsort((rng.random(nk3d), shell))
+  rank = np.arange(nk3d) - shellstart[shell[order]]
+  keep = np.sort(order[rank < nkeep[shell[order]]])
+
+  # Reweight so that each shell keeps its full degeneracy
+  keptdegen = np.bincount(shell[keep], weights=weights[keep], minlength=nshell)
+  newweights = weights[keep]*(histndegen/keptdegen)[shell[keep]]
+
+  # === closing ===
+  pruned = np.flatnonzero(binsize > n_per_bin)
+  if verbose:
+    print("Originally had {} vecs, pruned down to {}.".format(nk3d,len(keep)))
+    print("About {} vectors kept in each of the {} |k| bins of width {} starting at {}".format(n_per_bin, len(pruned), resolution, pruned*resolution))
+  if debug:
+    for s in range(nshell):
+      print(s, histabcissae[s], shellsize[s], nkeep[s], histndegen[s], keptdegen[s])
+  return kmesh3d[keep], modklist[keep], len(keep), newweights
 
-  finalmesh.extend(binvecs)
-  #bins.append(histabcissae[-1])
 
-  nk3d = np.shape(finalmesh)[0]
-  modklist = np.zeros(nk3d)
-  for ik,kvec in enumerate(finalmesh):
-      modklist[ik] = np.linalg.norm(kvec)
+INDEXCHUNK = 2**26 # bytes read at a time while indexing a LAMMPS dump
+
+
+class LammpsDump(object):
+  """ Streaming reader for LAMMPS text dumps (ITEM: ATOMS id type x y z ...)
+
+  The first pass only records the byte offset of each frame, searching the raw file in large
+  chunks. Frames are then read by seeking to their offset, and the atom block of each frame is
+  parsed with a single np.loadtxt call. Atoms are sorted by id, coordinates are taken from the
+  x/y/z, xu/yu/zu or scaled xs/ys/zs columns and shifted to the lower box bounds. Lengths stay in
+  the units of the dump. Only orthogonal boxes are supported.
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+    marker = b"ITEM: TIMESTEP"
+    offsets = []
+    with open(filename, "rb") as f:
+      pos = 0
+      tail = b""
+      buf = f.read(INDEXCHUNK)
+      while buf:
+        data = tail + buf
+        base = pos - len(tail)
+        i = data.find(marker)
+        while i >= 0:
+          offsets.append(base + i)
+          i = data.find(marker, i+1)
+        tail = data[-(len(marker)-1):] # too short to hold a whole marker, so nothing is found twice
+        pos += len(buf)
+        buf = f.read(INDEXCHUNK)
+    if len(offsets) == 0:
+      raise ValueError("{} is not a LAMMPS dump: no ITEM: TIMESTEP found".format(filename))
+    self.offsets = np.array(offsets + [pos], dtype=np.int64)
+
+    # Layout of the atom records, from the first frame
+    header = self._readFrame(0).split(b"\n", 9)
+    self.natoms = int(header[3])
+    columns = header[8].decode().split()[2:]
+    self.ncolumns = len(columns)
+    for x in [("x","y","z"), ("xu","yu","zu"), ("xs","ys","zs")]:
+      if all(c in columns for c in x):
+        self.scaled = x[0] == "xs"
+        self.usecols = [columns.index(c) for c in ("id","type") + x]
+        break
+    else:
+      raise ValueError("{}: no x y z, xu yu zu or xs ys zs columns in ITEM: ATOMS {}".format(filename, " ".join(columns)))
+    # A frame still being written (e.g. by a running simulation) is left out
+    if not self._complete(self._readFrame(len(self.offsets)-2)):
+      self.offsets = self.offsets[:-1]
+    self.nframes = len(self.offsets) - 1
+    self.types = self.readFrames([0])[2]
+
+  def __len__(self):
+    return self.nframes
+
+  def _complete(self, data):
+    """ Whether data holds a whole frame: all of its atom records, the last one with every column """
+    header = data.split(b"\n", 9)
+    if len(header) < 10:
+      return False
+    records = [l for l in header[9].split(b"\n") if l.strip()]
+    return len(records) >= int(header[3]) and len(records[-1].split()) >= self.ncolumns
+
+  def _readFrame(self, iframe):
+    with open(self.filename, "rb") as f:
+      f.seek(self.offsets[iframe])
+      return f.read(self.offsets[iframe+1] - self.offsets[iframe])
+
+  def _parseFrame(self, data):
+    header = data.split(b"\n", 9)
+    if int(header[3]) != self.natoms:
+      raise ValueError("{}: frame at timestep {} has {} atoms, not {}".format(self.filename, int(header[1]), int(header[3]), self.natoms))
+    if len(header[4].split()) > 6:
+      raise ValueError("{}: triclinic boxes are not supported ({})".format(self.filename, header[4].decode()))
+    bounds = np.array([l.split()[:2] for l in header[5:8]], dtype=np.float64)
+    atoms = np.loadtxt(io.BytesIO(header[9]), usecols=self.usecols, ndmin=2)
+    atoms = atoms[np.argsort(atoms[:,0], kind='stable')]
+    box = bounds[:,1] - bounds[:,0]
+    xyz = atoms[:,2:5]*box if self.scaled else atoms[:,2:5] - bounds[:,0]
+    return xyz, box, atoms[:,1].astype(int)
+
+  def readFrames(self, frames):
+    """ Coordinates [n, natoms, 3], box lengths [n, 3] and (for the first of them) LAMMPS atom types [natoms] of the given frames """
+    parsed = [self._parseFrame(self._readFrame(f)) for f in frames]
+    return np.array([p[0] for p in parsed]), np.array([p[1] for p in parsed]), parsed[0][2]
+
+  def iterFrames(self, skip=0, stride=1, nblock=1, nframes=None):
+    """ Stream blocks of frames, reading only the frames that are used
+
+    Frames skip, skip+stride, ... (the first nframes of them, or up to the end of the dump) are read
+    nblock at a time. Yields the file index of the first frame of each block, its coordinates
+    [nblock, natoms, 3] and its box lengths [nblock, 3]; the last block may be shorter.
+    """
+    frames = range(skip, self.nframes, stride)
+    if nframes is not None:
+      frames = frames[:nframes]
+    for i0 in range(0, len(frames), nblock):
+      block = frames[i0:i0+nblock]
+      xyz, boxes = self.readFrames(block)[:2]
+      yield block[0], xyz, boxes
+
+
+def residueMap(top, weighting="com"):
+  """ Map the atoms of the topology to their residues, for residueCentres
+
+  Parameters
+  ----------
+  top : mdtraj.Topology
+      topology of the system
+  weighting : str
+      'com' for mass-weighted centres, 'cog' for geometric centres; residues without
+      any mass (e.g. coarse-grained beads without elements) fall back to geometric centres
+
+  Returns
+  -------
+  tuple
+      residues = (resindex, weights, refatom, nres): 0-based residue of each atom, weight of each atom
+      normalized within its residue, first atom of each residue, and the number of residues
+  """
+  natoms = top.n_atoms
+  nres = top.n_residues
+  resindex = np.array([a.residue.index for a in top.atoms], dtype=int)
+  if weighting == "com":
+    w = np.array([a.element.mass if a.element is not None else 0. for a in top.atoms], dtype=np.float64)
+  else:
+    w = np.ones(natoms)
+  massless = np.bincount(resindex, weights=w, minlength=nres) <= 0.
+  if np.any(massless):
+    print("{} residues without mass use their geometric centre".format(np.count_nonzero(massless)))
+    w[massless[resindex]] = 1.
+  weights = w/np.bincount(resindex, weights=w, minlength=nres)[resindex]
+  refatom = np.full(nres, natoms)
+  np.minimum.at(refatom, resindex, np.arange(natoms))
+  return resindex, weights, refatom, nres
+
+
+def residueCentres(xyz, boxes, residues):
+  """ Weighted centres of the residues, computed for a block of frames with bincount
+
+  Each atom is first placed at its minimum image from the first atom of its residue, so residues
+  split by the periodic boundaries are made whole; the centres are then wrapped into the box.
+
+  Parameters
+  ----------
+  xyz : nparray
+      coordinates, [nframes, natoms, 3]
+  boxes : nparray
+      box lengths, [nframes, 3]
+  residues : tuple
+      residue map from residueMap
+
+  Returns
+  -------
+  nparray
+      centres, [nframes, nres, 3]
+  """
+  resindex, weights, refatom, nres = residues
+  xyz = np.asarray(xyz, dtype=np.float64)
+  nframes = len(xyz)
+  boxes = np.asarray(boxes, dtype=np.float64)[:,None,:]
+  d = xyz - xyz[:,refatom[resindex]]
+  d -= boxes*np.rint(d/boxes)
+  binidx = (np.arange(nframes)[:,None]*nres + resindex[None,:]).ravel()
+  shift = np.stack([np.bincount(binidx, weights=(d[...,c]*weights).ravel(), minlength=nframes*nres) for c in range(3)], axis=-1)
+  centres = xyz[:,refatom] + np.reshape(shift, [nframes, nres, 3])
+  return centres - boxes*np.floor(centres/boxes)
+
+
+def speciesIndex(top, typedict):
+  """ Map every atom of the topology to a 0-based species index
+
+  Parameters
+  ----------
+  top : mdtraj.Topology
+      topology of the system
+  typedict : dict
+      atom name -> 1-based species index
+
+  Returns
+  -------
+  nparray
+      specidx, [natoms] integer array of 0-based species indices
+  """
+  return np.array([typedict[atom.name]-1 for atom in top.atoms], dtype=int)
+
+
+PHASEBYTES = 16 # bytes per (frame, atom, k) element of the direct phase tile: k.r plus one cos/sin buffer
+RECBYTES = 32   # bytes per element of the recurrence phase tile: exp(ik.r) plus one gathered factor
+KTILEMIN = 64   # smallest k tile before we also start tiling over atoms
+TILEBYTES = 2**21 # default phase tile working set; small enough to stay cache resident
+RHOBUFBYTES = 2**26 # frames of rho buffered by RhoStore before they are written
+FKTBYTES = 2**26 # working set of the FFT correlation in collectiveFkt
 
-  # === closing ===
-  print("Originally had {} vecs, pruned down to {}.".format(np.shape(kmesh3d)[0],nk3d))
-  print("At most {} vectors in each of the following {} bins {}".format(n_per_bin, ibin+1,bins))
-  return finalmesh, modklist, nk3d
 
+def parseMemory(size):
+  """ Convert a memory size such as '2GB', '512MB' or '1e9' to bytes """
+  units = {"K":1e3, "M":1e6, "G":1e9, "T":1e12}
+  size = size.strip().upper().rstrip("B")
+  if size and size[-1] in units:
+    return int(float(size[:-1])*units[size[-1]])
+  return int(float(size))
 
 
-def lammpsHeaderInfo(trajfile):
-  """ Parse Header and First Frame
- 
+def chooseTiles(nframes, natoms, nk3d, tileBytes=None, elembytes=PHASEBYTES):
+  """ Pick (frame, atom, k) tile sizes so that the phase tile stays within tileBytes
+
+  Only the phase tile is sized here; rho, the power tables of the recurrence and the S(k) sums
+  come on top of it.
+
   Parameters
   ----------
-  file
-      file-obj reading from the trajectory file
+  nframes, natoms, nk3d : int
+      full extent of the phase matrix
+  tileBytes : int
+      size in bytes of the phase tile working set, None for the cache-sized default TILEBYTES
+  elembytes : int
+      bytes needed per element of the phase tile
 
   Returns
   -------
-  info : dict
-      dictionary of the meta-data read from the function.
+  ftile, atile, ktile : int
+      tile sizes over frames, atoms and k vectors
   """
-  # Parse through the file for header information
-  foundBox=False
-  foundNatoms=False
-  error=False
-  info = {}
-  line = trajfile.readline()
-  while line:
-    if line.splitlines()[0] == "ITEM: NUMBER OF ATOMS":
-      natoms = int(args.file.readline().split()[0])
-      foundNatoms = True
-      print( "# particles = ",natoms )
-      info["natoms"]=natoms
-    if line.splitlines()[0] == "ITEM: BOX BOUNDS pp pp pp":
-      line2 = args.file.readline().split()
-      Lmin = line2[0]
-      Lmax = line2[1]
-      line2 = args.file.readline().split()
-      if Lmin != line2[0] or Lmax != line2[1]:
-        status="Box not cubic!"
-        error = True
-      line2 = args.file.readline().split()
-      if Lmin != line2[0] or Lmax != line2[1]:
-        status="Box not cubic!"
-        error = True
-      foundBox = True
-      Lmin = float(Lmin)
-      Lmax = float(Lmax)
-      print( "Box bounds = ",Lmin, Lmax )
-      info["Lmin"] = Lmin
-      info["Lmax"] = Lmax
-    if foundBox and foundNatoms:
-      break
-    line = args.file.readline()
-  # Quit if the file does not contain the required records
-  if not foundBox or not foundNatoms:
-    status="Header information not complete"
-    error=True
-
-  # Determine the number of species by scanning through the first frame
-  nspec=0
-  # Skip header
-  line = trajfile.readline()
-  # Loop over particle coordinates
-  for atomidx in range(natoms):
-    line = trajfile.readline().split()
-    if int(line[0]) != atomidx+1:
-      status="Format error: {}".format(line)
-      error = True
-    spec = int(line[1])
-    if spec > nspec:
-        nspec = spec
-  print( "Number of species present = {}".format(nspec) )
-  info["nspec"] = nspec
-
-  if not error:
-    status = "Successfully read"
-    info = {"natoms":natoms, "Lmin":Lmin, "Lmax":Lmax, "nspec":nspec}
-  return error, status, info
-
-
-def SKengine():
+  nelem = max(int((TILEBYTES if tileBytes is None else tileBytes)/elembytes), 1)
+  if nframes*natoms*nk3d <= nelem:
+    return nframes, natoms, nk3d
+  # Keep the largest tiles possible so that throughput stays close to the untiled kernel:
+  # first go frame by frame and tile over k vectors, then tile over atoms as well
+  if natoms*min(nk3d,KTILEMIN) <= nelem:
+    return 1, natoms, min(nk3d, nelem//natoms)
+  ktile = min(nk3d, KTILEMIN)
+  return 1, max(nelem//ktile, 1), ktile
+
+
+def latticeIndex(kmesh3d, dk, tol=1.e-6):
+  """ Integer lattice offsets (i,j,k) of the wave vectors, such that kvec = (i,j,k)*dk
+
+  Returns None if the k set does not lie on the lattice.
+  """
+  kmesh3d = np.asarray(kmesh3d)
+  kindex = np.rint(kmesh3d/dk).astype(int)
+  if np.max(np.abs(kindex*dk - kmesh3d), initial=0.) > tol*np.max(dk):
+    return None
+  return kindex
+
+
+def latticePowers(x, dk, nlo, nhi):
+  """ exp(i*n*dk*x) for n = nlo..nhi, built by repeated complex multiplication
+
+  Only one cos/sin pair is evaluated per coordinate, as in classic Ewald codes.
+
+  Returns
+  -------
+  nparray
+      powers, complex [x.shape, nhi-nlo+1]; the power n is stored at index n-nlo
+  """
+  nlo = min(nlo, 0)
+  nhi = max(nhi, 0)
+  e1 = np.exp(1j*dk*x)
+  e1conj = np.conj(e1)
+  powers = np.empty(x.shape+(nhi-nlo+1,), dtype=complex)
+  powers[...,-nlo] = 1.0
+  for n in range(1, nhi+1):
+    powers[...,n-nlo] = powers[...,n-1-nlo]*e1
+  for n in range(-1, nlo-1, -1):
+    powers[...,n-nlo] = powers[...,n+1-nlo]*e1conj
+  return powers
+
+
+def SKengine(xyz, kmesh3d, specidx, nspec, tileBytes=None, kindex=None, dk=None):
     """ Core code for calculating SK 
-    
+
+    Computes the species-resolved collective densities rho_i(k) = sum_{a in i} exp(ik.r_a)
+    for a block of frames at once, with no Python-level loop over atoms. The natoms x nk3d
+    phase matrix is evaluated in tiles of about tileBytes.
+
+    Runs use the lattice recurrence (kindex), which replaces the cos/sin of every (atom, k) pair
+    by complex multiplies. Without kindex, exp(ik.r) is evaluated with direct cos/sin; that path is
+    bound by cos/sin like a per-atom loop, and is only kept as the reference for the accuracy of
+    the recurrence. Dense k meshes are faster still with PMengine.
+
     Parameters
     ----------
+    xyz : nparray
+        coordinates, [nframes, natoms, 3]
+    kmesh3d : nparray
+        wave vectors, [nk3d, 3]
+    specidx : nparray
+        0-based species index of each atom, [natoms]
+    nspec : int
+        number of species
+    tileBytes : int
+        size in bytes of the phase tile working set, None for the cache-sized default (see chooseTiles)
+    kindex : nparray
+        integer lattice offsets of kmesh3d (see latticeIndex). If given, exp(ik.r) is built
+        from per-atom powers of exp(i*dk*x), exp(i*dk*y), exp(i*dk*z) with complex multiplies
+        instead of one cos/sin per (atom, k) pair
+    dk : float or nparray
+        lattice spacing of the k mesh, needed with kindex
 
     Returns
     -------
+    nparray
+        rho, complex [nframes, nspec, nk3d]
+    """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    nframes, natoms = xyz.shape[0], xyz.shape[1]
+    nk3d = len(kmesh3d)
+    # Species membership matrix; reduces the per-atom phases to per-species sums with a matrix product
+    onehot = np.zeros([nspec, natoms])
+    onehot[specidx, np.arange(natoms)] = 1.0
+    kmeshT = np.transpose(kmesh3d)
+    if kindex is not None:
+      dk = np.broadcast_to(np.asarray(dk, dtype=np.float64), [3])
+      nlo = np.min(kindex, axis=0)
+      nhi = np.max(kindex, axis=0)
+      # column of each k vector in the power tables
+      kcols = [kindex[:,d] - min(nlo[d],0) for d in range(3)]
+
+    ftile, atile, ktile = chooseTiles(nframes, natoms, nk3d, tileBytes, PHASEBYTES if kindex is None else RECBYTES)
+    rho = np.zeros([nframes, nspec, nk3d], dtype=complex)
+    for f0 in range(0, nframes, ftile):
+      f1 = min(f0+ftile, nframes)
+      for a0 in range(0, natoms, atile):
+        a1 = min(a0+atile, natoms)
+        if kindex is not None:
+          powers = [latticePowers(xyz[f0:f1,a0:a1,d], dk[d], nlo[d], nhi[d]) for d in range(3)]
+        for k0 in range(0, nk3d, ktile):
+          k1 = min(k0+ktile, nk3d)
+          if kindex is None:
+            kdotr = np.matmul(xyz[f0:f1,a0:a1], kmeshT[:,k0:k1]) # [ftile, atile, ktile]
+            trig = np.cos(kdotr)
+            rho[f0:f1,:,k0:k1].real += np.matmul(onehot[:,a0:a1], trig)
+            np.sin(kdotr, out=trig)
+            rho[f0:f1,:,k0:k1].imag += np.matmul(onehot[:,a0:a1], trig)
+          else:
+            phase = np.take(powers[0], kcols[0][k0:k1], axis=-1) # [ftile, atile, ktile]
+            phase *= np.take(powers[1], kcols[1][k0:k1], axis=-1)
+            phase *= np.take(powers[2], kcols[2][k0:k1], axis=-1)
+            # reduce real and imaginary parts together by viewing the complex tile as float pairs
+            rho[f0:f1,:,k0:k1] += np.matmul(onehot[:,a0:a1], phase.view(np.float64)).view(complex)
+    return rho
+
+
+PMORDER = {"cic":2, "tsc":3} # assignment order (points per axis) of the particle-mesh engine
 
+
+def assignmentWeights(u, order):
+  """ Grid points and weights of the CIC (order 2) or TSC (order 3) assignment along one axis
+
+  Parameters
+  ----------
+  u : nparray
+      positions in units of the grid spacing
+  order : int
+      2 for cloud-in-cell, 3 for triangular-shaped cloud
+
+  Returns
+  -------
+  idx : nparray
+      unwrapped grid indices, [u.shape, order]
+  wts : nparray
+      assignment weights, [u.shape, order]
+  """
+  if order == 2:
+    i0 = np.floor(u)
+    d = u - i0
+    idx = i0[...,None] + np.arange(2)
+    wts = np.stack([1.-d, d], axis=-1)
+  else:
+    i0 = np.rint(u)
+    d = u - i0
+    idx = i0[...,None] + np.arange(-1,2)
+    wts = np.stack([0.5*(0.5-d)**2, 0.75-d**2, 0.5*(0.5+d)**2], axis=-1)
+  return idx.astype(int), wts
+
+
+def pmGridSize(kindex):
+  """ Default particle-mesh grid: the smallest power of two with 4x oversampling of the largest lattice offset """
+  nmax = max(int(np.max(np.abs(kindex))), 1)
+  return int(2**np.ceil(np.log2(4*nmax)))
+
+
+def PMengine(xyz, L, kindex, specidx, nspec, M, order=PMORDER["tsc"]):
+    """ Particle-mesh alternative to SKengine
+
+    Spreads each species' density onto an M^3 grid, takes one 3D FFT per species and reads off
+    the modes of the k mesh, dividing out the Fourier transform of the assignment window.
+    Costs O(natoms + M^3 log M) per frame instead of O(natoms x nk3d).
+
+    Parameters
+    ----------
+    xyz : nparray
+        coordinates, [nframes, natoms, 3]
+    L : float or nparray
+        box lengths
+    kindex : nparray
+        integer lattice offsets of the k mesh (see latticeIndex), [nk3d, 3]
+    specidx : nparray
+        0-based species index of each atom, [natoms]
+    nspec : int
+        number of species
+    M : int
+        grid points per axis; all offsets must satisfy 2|n| < M
+    order : int
+        assignment order, see PMORDER
+
+    Returns
+    -------
+    nparray
+        rho, complex [nframes, nspec, nk3d]
     """
+    xyz = np.asarray(xyz, dtype=np.float64)
+    nframes = xyz.shape[0]
+    h = np.broadcast_to(np.asarray(L, dtype=np.float64), [3])/M
+    # Deconvolution of the assignment window, W(k) = prod_d sinc(n_d/M)^order
+    window = np.prod(np.sinc(kindex/float(M))**order, axis=1)
+    # np.fft uses exp(-i k.r); rho(k) = sum exp(+ik.r) sits at -n
+    modes = [(-kindex[:,d]) % M for d in range(3)]
+    specoffset = (specidx*M**3)[:,None,None,None]
+
+    rho = np.empty([nframes, nspec, len(kindex)], dtype=complex)
+    for f in range(nframes):
+      ix, wx = assignmentWeights(xyz[f,:,0]/h[0], order)
+      iy, wy = assignmentWeights(xyz[f,:,1]/h[1], order)
+      iz, wz = assignmentWeights(xyz[f,:,2]/h[2], order)
+      # flattened (species, x, y, z) grid index and weight of the order^3 contributions of each atom
+      cell = (((ix % M)[:,:,None,None]*M + (iy % M)[:,None,:,None])*M + (iz % M)[:,None,None,:]) + specoffset
+      wt = wx[:,:,None,None]*wy[:,None,:,None]*wz[:,None,None,:]
+      grid = np.bincount(cell.ravel(), weights=wt.ravel(), minlength=nspec*M**3).reshape([nspec,M,M,M])
+      # one species at a time, so that only one complex grid is alive
+      for s in range(nspec):
+        rho[f,s] = np.fft.fftn(grid[s])[modes[0], modes[1], modes[2]]/window
+    return rho
+
+
+def rhoFrames(xyz, setup):
+  """ Compute rho_i(k) for a block of frames with the engine selected in setup
+
+  setup holds the k mesh, species map and engine options shared by the serial loop and SKworker.
+  """
+  if setup["engine"] == "pm":
+    return PMengine(xyz, setup["L"], setup["klattice"], setup["specidx"], setup["nspec"], setup["pmgrid"], setup["pmorder"])
+  return SKengine(xyz, setup["kmesh3d"], setup["specidx"], setup["nspec"], setup["tileBytes"], setup["kindex"], setup["dk"])
 
 
-# TODO:
-# Generate k mesh in the subroutine. Exploit k -> -k symmetry. Use spherical cutoff
-# Allow Lx, Ly, Lz different
-#
-# **NEXT:** 1D histogram: sort K vectors by magnitude, then set up a map histmap[ik3d] = ikhist; also keep a degeneracy map (for normalizing the histogram) and nkhist (grid max for allocs)
-#  File directly into these in CI, CJ, SI, SJ and use the degeneracies to normalize
-#
-# MOVE HISTOGRAM DATA STRUCTURE SETUP INTO GRID FUNCTION
+class KmeshCache(object):
+  """ k mesh for the current box of an NPT run, rebuilt only when the box changes
+
+  The mesh is reused while every box length stays within a relative tolerance of the box it was
+  built for. Wave vectors are binned into fixed |k| shells of width kbin (shell 0 holds k=0 alone),
+  so that frames with different boxes fill the same shells and can be averaged together. Shell n >= 1
+  is centred on n*kbin. With prune, every new mesh is thinned by pruneKmesh.
+  """
+
+  def __init__(self, kmax, kbin, tol=1.e-6, HalfSpace=True, engine='direct', pmgrid=0, prune=None, Normal=None):
+    self.kmax = kmax
+    self.kbin = kbin
+    self.tol = tol
+    self.HalfSpace = HalfSpace
+    self.engine = engine
+    self.pmgrid = pmgrid
+    self.prune = prune # (resolution, n_per_bin, seed) of pruneKmesh, or None
+    self.Normal = Normal
+    # The cubic mesh of generateKmesh(SphCut=False) stays inside |k| < kmax for any orthorhombic box
+    self.nshell = int(np.rint(kmax/kbin)) + 2
+    self.histabcissae = np.arange(self.nshell)*kbin
+    self.box = None
+    self.nbuild = 0
+
+  def matches(self, box):
+    """ Whether the cached mesh can be used for box (Lx, Ly, Lz) """
+    return self.box is not None and np.all(np.abs(np.asarray(box) - self.box) <= self.tol*self.box)
+
+  def update(self, box):
+    """ Rebuild the mesh unless box matches the cached one; returns True if the mesh changed """
+    if self.matches(box):
+      return False
+    self.box = np.array(box, dtype=np.float64)
+    self.dk = 2*np.pi/self.box
+    self.kmesh3d, modklist, self.nk3d = generateKmesh(self.box, self.kmax, SphCut=False, HalfSpace=self.HalfSpace, Normal=self.Normal, verbose=False)
+    self.kweights = halfSpaceWeights(self.kmesh3d) if self.HalfSpace else np.ones(self.nk3d, dtype=int)
+    if self.prune is not None:
+      resolution, n_per_bin, seed = self.prune
+      self.kmesh3d, modklist, self.nk3d, self.kweights = pruneKmesh(self.kmesh3d, modklist, resolution, n_per_bin, self.kweights, seed, verbose=False)
+    self.shellmap = np.where(modklist > 0, np.maximum(np.rint(modklist/self.kbin), 1), 0).astype(int)
+    self.nbuild += 1
+    return True
+
+  def engineSetup(self):
+    """ Entries of the setup (see rhoFrames and SKworker) that depend on the mesh """
+    klattice = latticeIndex(self.kmesh3d, self.dk)
+    setup = {"kmesh3d":self.kmesh3d, "dk":self.dk, "kindex":klattice,
+             "shellmap":self.shellmap, "kweights":self.kweights}
+    if self.engine == 'pm':
+      # the lattice offsets grow with the box, so the grid is re-sized when it no longer resolves them
+      pmgrid = self.pmgrid if 2*np.max(np.abs(klattice)) < self.pmgrid else pmGridSize(klattice)
+      setup.update({"L":self.box, "klattice":klattice, "pmgrid":pmgrid})
+    return setup
+
+
+def isLammpsDump(trjfile):
+  """ Whether a trajectory file name looks like a LAMMPS text dump (dump.*, *.dump)
+
+  *.lammpstrj is left to mdtraj, which converts to nm and takes the species from the topology.
+  """
+  name = os.path.basename(trjfile)
+  return name.startswith("dump.") or name.endswith(".dump")
+
+
+def countFrames(trjfile, top=None, chunk=100):
+  """ Number of frames in a trajectory file (or LammpsDump)
+
+  Read from the file without decoding coordinates where mdtraj can; formats whose length is not
+  available that way (e.g. gro, mdcrd, lammpstrj) are read through once with the topology instead.
+  """
+  if isinstance(trjfile, LammpsDump):
+    return len(trjfile)
+  try:
+    with md.open(trjfile) as f:
+      return len(f)
+  except (TypeError, ValueError, NotImplementedError):
+    return sum(traj.n_frames for traj in md.iterload(trjfile, top=top, chunk=chunk))
+
+
+def iterFrames(trjfile, top, skip=0, stride=1, chunk=100, nblock=1, nframes=None):
+  """ Stream blocks of frames from a trajectory
+
+  Skip and stride are applied at read time, so memory is bounded by the chunk size.
+
+  Parameters
+  ----------
+  trjfile : str or LammpsDump
+      trajectory file read with mdtraj, or an indexed LAMMPS dump (which is read one block at a time)
+  top : mdtraj.Topology
+      topology, not used for a LammpsDump
+  skip : int
+      index of the first frame used
+  stride : int
+      use every stride-th frame from there on
+  chunk : int
+      number of frames read from the file at a time
+  nblock : int
+      number of frames in each yielded block
+  nframes : int
+      stop after this many used frames, None for the end of the file
+
+  Yields
+  ------
+  iframe : int
+      file index of the first frame of the block
+  xyz : nparray
+      coordinates of the block, [nblock, natoms, 3]
+  boxes : nparray
+      box lengths of each frame of the block, [nblock, 3]
+
+  Raises
+  ------
+  ValueError
+      at the first frame with a triclinic box, which the k mesh does not support
+  """
+  if isinstance(trjfile, LammpsDump):
+    for block in trjfile.iterFrames(skip, stride, nblock, nframes):
+      yield block
+    return
+  iframe = skip
+  nused = 0
+  for traj in md.iterload(trjfile, top=top, chunk=chunk, skip=skip, stride=stride):
+    # The k mesh is built on the box lengths alone, so a triclinic box (e.g. later in an NPT run) is an error
+    tilted = np.any(np.abs(traj.unitcell_angles - 90.) > 1.e-3, axis=1)
+    if np.any(tilted):
+      raise ValueError("{}: triclinic boxes are not supported, box angles = {}".format(trjfile, traj.unitcell_angles[tilted][0]))
+    for iblock in range(0, traj.n_frames, nblock):
+      xyz = traj.xyz[iblock:iblock+nblock]
+      boxes = traj.unitcell_lengths[iblock:iblock+nblock]
+      if nframes is not None:
+        xyz = xyz[:nframes-nused]
+        boxes = boxes[:nframes-nused]
+        if len(xyz) == 0:
+          return
+      yield iframe, xyz, boxes
+      iframe += len(xyz)*stride
+      nused += len(xyz)
+
+
+def packedPairs(nspec):
+  """ Packed upper-triangle storage of the species pairs
+
+  S_ij = S_ji, so each pair is stored once, for i <= j, in the row-major order of np.triu_indices:
+  row i starts at packed index i*nspec - i*(i-1)/2.
+
+  Returns
+  -------
+  nparray
+      pairmap, [nspec, nspec] packed index of pair (i, j), the same as that of (j, i)
+  """
+  iu, ju = np.triu_indices(nspec)
+  pairmap = np.empty([nspec, nspec], dtype=int)
+  pairmap[iu, ju] = np.arange(len(iu))
+  pairmap[ju, iu] = np.arange(len(iu))
+  return pairmap
+
+
+def accumulateSK(SK, rho, pair=None):
+  """ Add Re(rho_i(k) conj(rho_j(k))), summed over the frames of a block, to the mesh sums SK
+
+  Parameters
+  ----------
+  SK : nparray
+      mesh sums, [nspec*(nspec+1)/2, nk3d] in packed pair order (see packedPairs) for the full
+      matrix or [1, nk3d] for a single pair
+  rho : nparray
+      complex densities from SKengine, [nframes, nspec, nk3d]
+  pair : tuple
+      0-based (i, j) for a single pair, None for the full matrix
+  """
+  # Sk[i][j] += cos[i]*cos[j] + sin[i]*sin[j] = Re(rho[i]*conj(rho[j])), for j >= i only
+  if pair is None:
+    nspec = rho.shape[1]
+    for i in range(nspec):
+      p0 = i*nspec - i*(i-1)//2
+      SK[p0:p0+nspec-i] += np.real(np.einsum('fk,fjk->jk', rho[:,i], np.conj(rho[:,i:])))
+  else:
+    SK[0] += np.real(np.sum(rho[:,pair[0]]*np.conj(rho[:,pair[1]]), axis=0))
+
+
+def processBlock(acc, iframe, xyz, boxes, setup):
+  """ Compute rho_i(k) for a block of frames (see rhoFrames) and add it to the accumulator
+
+  With an NPT mesh cache in setup, the block is split into runs of frames that share the cached
+  mesh; when the box changes the mesh is rebuilt and the accumulator switched over to it.
+  Otherwise the mesh is that of setup["box"], and we warn once if the box drifts away from it.
+  With a RhoStore in setup, rho_i(k) of its wave vectors is also kept for F(k,t), and with a
+  residue map the atoms are first reduced to residue centres (see residueCentres).
+  """
+  if setup["residues"] is not None:
+    xyz = residueCentres(xyz, boxes, setup["residues"])
+  cache = setup["meshcache"]
+  if cache is None:
+    if not setup["boxwarned"] and np.any(np.abs(boxes - setup["box"]) > setup["boxtol"]*setup["box"]):
+      print("Warning: the box changes during the trajectory, but the k mesh is built for the first frame; use --npt")
+      setup["boxwarned"] = True
+    rho = rhoFrames(xyz, setup)
+    acc.add(rho, setup["pair"])
+    if setup["rhostore"] is not None:
+      setup["rhostore"].write(iframe, rho)
+    return
+  f0 = 0
+  while f0 < len(xyz):
+    if cache.update(boxes[f0]):
+      acc.setMesh(cache.shellmap, cache.kweights)
+      setup.update(cache.engineSetup())
+    f1 = f0 + 1
+    while f1 < len(xyz) and cache.matches(boxes[f1]):
+      f1 += 1
+    acc.add(rhoFrames(xyz[f0:f1], setup), setup["pair"])
+    f0 = f1
+
+
+_SKworkerSetup = {}
+
+def initSKworker(setup):
+  """ Pool initializer: keep the mesh, species map and engine options (see rhoFrames) in the worker process """
+  _SKworkerSetup.update(setup)
+
+
+def SKworker(shard):
+  """ Accumulate S(k) over one contiguous shard of frames
+
+  Parameters
+  ----------
+  shard : tuple
+      (index of the first frame, number of frames, frames already in the open error block)
+
+  Returns
+  -------
+  SKAccumulator
+      partial sums and error blocks for every species pair
+  int
+      number of k meshes built for the shard (with --npt)
+  """
+  w = _SKworkerSetup
+  first, nframes, nopen = shard
+  nbuild = 0 if w["meshcache"] is None else w["meshcache"].nbuild
+  acc = SKAccumulator(w["SKshape"], w["shellmap"], w["kweights"], w["nshell"], w["blocksize"])
+  acc.startInBlock(nopen) # the first block closes where the open block of the accumulator merged into would (see merge)
+  for iframe, xyz, boxes in iterFrames(w["trjfile"], w["top"], first, w["stride"], w["chunk"], w["nblock"], nframes):
+    processBlock(acc, iframe, xyz, boxes, w)
+  if w["rhostore"] is not None:
+    w["rhostore"].flush()
+  return acc, 0 if w["meshcache"] is None else w["meshcache"].nbuild - nbuild
+
+
+def histogramSK(SK, shellmap, kweights, nshell):
+  """ Fold S(k) on the 3d mesh into |k| shells with one weighted bincount
+
+  Parameters
+  ----------
+  SK : nparray
+      structure factor sums on the 3d mesh, [..., nk3d]
+  shellmap : nparray
+      histogram (shell) index of each 3d mesh point, [nk3d]
+  kweights : nparray
+      number of full-mesh points each 3d mesh point stands for, [nk3d]
+  nshell : int
+      number of |k| shells
+
+  Returns
+  -------
+  nparray
+      SKhist, [..., nshell]
+  """
+  lead = np.shape(SK)[:-1]
+  npair = int(np.prod(lead))
+  nk3d = len(shellmap)
+  binidx = (np.arange(npair)[:,None]*nshell + shellmap[None,:]).ravel()
+  SKhist = np.bincount(binidx, weights=(np.reshape(SK,[npair,nk3d])*kweights).ravel(), minlength=npair*nshell)
+  return np.reshape(SKhist, lead+(nshell,))
+
+
+def writeSK(filename, header, values, histabcissae):
+  """ Write shell-averaged values, one row per |k| shell (skipping k=0), one column per entry of values[..., :] """
+  values = np.reshape(values, [-1, len(histabcissae)])
+  skfile = open(filename,"w")
+  skfile.write(header)
+  for ik in range(1,len(histabcissae)): # Start at idx=1 -- miss k=0
+    skfile.write("{} {}\n".format(histabcissae[ik], " ".join(["{}".format(v) for v in values[:,ik]])))
+  skfile.close()
+
+
+class SKAccumulator(object):
+  """ Running S(k) sums, reduced to |k| shells in blocks of frames
+
+  Frames are summed on the 3d mesh and folded into the shells with histogramSK when a block
+  closes or the mesh changes (see setMesh). Alongside the shell sums we keep the number of mesh
+  points that went into each shell, so that frames on different meshes average correctly. For
+  block-averaged error bars, each closed block only updates the running count, mean and sum of
+  squared deviations of the block averages of each shell (Welford), so memory and checkpoints stay
+  the same size however long the trajectory. The whole state can be saved to, and restored from,
+  a binary checkpoint.
+  """
+
+  def __init__(self, SKshape, shellmap, kweights, nshell, blocksize):
+    self.nshell = nshell
+    self.blocksize = blocksize
+    self.SK = np.zeros(SKshape)                             # mesh sums of the open block
+    self.nmesh = 0                                          # frames in the mesh sums
+    self.setMesh(shellmap, kweights)
+    self.openshell = np.zeros(tuple(SKshape[:-1])+(nshell,)) # shell sums of the open block folded so far
+    self.opendegen = np.zeros(nshell)                       # mesh points behind openshell
+    self.nopen = 0                                          # frames in the open block
+    self.closedsum = np.zeros_like(self.openshell)          # shell sums over all closed blocks
+    self.closeddegen = np.zeros(nshell)
+    self.nclosed = 0                                        # closed blocks
+    self.blockn = np.zeros(nshell, dtype=int)               # closed blocks that reached each shell
+    self.blockmean = np.zeros_like(self.openshell)          # mean of their block averages
+    self.blockM2 = np.zeros_like(self.openshell)            # sum of squared deviations from blockmean
+    self.headpending = False                                # see startInBlock
+    self.headsum = None
+    self.headdegen = None
+
+  @property
+  def nframes(self):
+    return self.nclosed*self.blocksize + self.nopen
+
+  def startInBlock(self, nopen):
+    """ Start inside an error block of which nopen frames were accumulated elsewhere (see SKworker)
+
+    The first block closed here then only holds part of that block, and is kept aside in headsum
+    for merge instead of entering the block statistics.
+    """
+    self.nopen = nopen
+    self.headpending = nopen > 0
+
+  def setMesh(self, shellmap, kweights):
+    """ Switch to another k mesh (e.g. after a box change), folding the sums on the current one first """
+    if self.nmesh > 0:
+      self.fold()
+    self.shellmap = shellmap
+    self.kweights = kweights
+    self.meshdegen = np.bincount(shellmap, weights=kweights, minlength=self.nshell) # full-mesh points per shell and frame
+    if self.SK.shape[-1] != len(shellmap):
+      self.SK = np.zeros(self.SK.shape[:-1]+(len(shellmap),))
+
+  def add(self, rho, pair=None):
+    """ Accumulate a block of frames from the engine (see accumulateSK), closing S(k) blocks at their boundaries """
+    f0 = 0
+    while f0 < len(rho):
+      f1 = min(len(rho), f0 + self.blocksize - self.nopen)
+      accumulateSK(self.SK, rho[f0:f1], pair)
+      self.nmesh += f1 - f0
+      self.nopen += f1 - f0
+      if self.nopen == self.blocksize:
+        self.closeBlock()
+      f0 = f1
+
+  def fold(self):
+    """ Fold the mesh sums of the open block into its shell sums """
+    self.openshell += histogramSK(self.SK, self.shellmap, self.kweights, self.nshell)
+    self.opendegen += self.nmesh*self.meshdegen
+    self.SK[...] = 0.
+    self.nmesh = 0
+
+  def addBlock(self, sums, degens):
+    """ Update the block statistics with the shell sums of one full block, in the shells it reached """
+    filled = degens > 0
+    x = sums/np.where(filled, degens, 1.)
+    self.blockn = self.blockn + filled
+    delta = np.where(filled, x - self.blockmean, 0.)
+    self.blockmean += delta/np.maximum(self.blockn, 1)
+    self.blockM2 += delta*(x - self.blockmean)
+
+  def closeBlock(self):
+    self.fold()
+    self.closedsum += self.openshell
+    self.closeddegen += self.opendegen
+    if self.headpending:
+      self.headsum = self.openshell.copy()
+      self.headdegen = self.opendegen.copy()
+      self.headpending = False
+    else:
+      self.addBlock(self.openshell, self.opendegen)
+    self.nclosed += 1
+    self.openshell[...] = 0.
+    self.opendegen[...] = 0.
+    self.nopen = 0
+
+  def merge(self, other):
+    """ Append the blocks of an accumulator over the next contiguous range of frames
+
+    If this accumulator ends inside an open block, other must have been started inside it (see
+    startInBlock), so that its first block completes the open one.
+    """
+    self.fold()
+    other.fold() # the two may sit on different meshes, so only shell sums are combined
+    if other.nclosed > 0:
+      if other.headsum is not None:
+        self.addBlock(self.openshell + other.headsum, self.opendegen + other.headdegen)
+      self.closedsum += self.openshell
+      self.closeddegen += self.opendegen
+      # Combine the block statistics of the two (Chan et al.)
+      n = self.blockn + other.blockn
+      nn = np.maximum(n, 1)
+      delta = other.blockmean - self.blockmean
+      self.blockM2 = self.blockM2 + other.blockM2 + delta**2*self.blockn*other.blockn/nn
+      self.blockmean = self.blockmean + delta*other.blockn/nn
+      self.blockn = n
+      self.nclosed += other.nclosed
+      self.openshell = other.openshell.copy()
+      self.opendegen = other.opendegen.copy()
+    else:
+      self.openshell += other.openshell
+      self.opendegen += other.opendegen
+    self.closedsum += other.closedsum
+    self.closeddegen += other.closeddegen
+    self.nopen = other.nopen
+
+  def shellSums(self):
+    """ Raw sums over all frames, per entry and |k| shell """
+    return self.closedsum + self.openshell + histogramSK(self.SK, self.shellmap, self.kweights, self.nshell)
+
+  def degenSums(self):
+    """ Number of full-mesh points summed into each |k| shell, over all frames """
+    return self.closeddegen + self.opendegen + self.nmesh*self.meshdegen
+
+  def average(self, natoms):
+    """ Shell-averaged S(k), normalized by the accumulated degeneracy (# mesh points x # frames) and # atoms
+
+    Shells that no mesh point has reached yet are NaN.
+    """
+    with np.errstate(invalid='ignore'):
+      return self.shellSums()/self.degenSums()/natoms
+
+  def blockErrors(self, natoms):
+    """ Standard error of the shell-averaged S(k) from the spread of full-block averages
+
+    Each shell only uses the blocks that reached it (with --npt a shell can be empty in some blocks);
+    shells reached by fewer than two blocks are NaN. Returns None with fewer than two full blocks.
+    """
+    if self.nclosed < 2:
+      return None
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return np.where(self.blockn >= 2, np.sqrt(self.blockM2/(self.blockn-1)/self.blockn), np.nan)/natoms
+
+  def save(self, filename, nextframe, histabcissae, settings):
+    """ Write the accumulator state to a binary checkpoint; nextframe is the first frame not yet accumulated
+
+    settings holds the run options a resumed run must share (see load), e.g. trajectory, skip, stride and species pair.
+    """
+    tmpname = filename + ".tmp.npz"
+    np.savez(tmpname, closedsum=self.closedsum, closeddegen=self.closeddegen, nclosed=self.nclosed,
+             blockn=self.blockn, blockmean=self.blockmean, blockM2=self.blockM2,
+             openshell=self.openshell + histogramSK(self.SK, self.shellmap, self.kweights, self.nshell),
+             opendegen=self.opendegen + self.nmesh*self.meshdegen,
+             nopen=self.nopen, blocksize=self.blocksize, nextframe=nextframe, histabcissae=histabcissae,
+             settings=np.array([(k, str(v)) for k,v in sorted(settings.items())], dtype=str))
+    os.rename(tmpname, filename) # Replace the previous checkpoint only once the new one is complete
+
+  def load(self, filename, histabcissae, settings):
+    """ Restore the accumulator state from a checkpoint written by save; returns the first frame not yet accumulated
+
+    Checkpoints that still hold the sums of every block (blocksums) are reduced to the block statistics.
+    Raises ValueError if the checkpoint was written for another k mesh, block size or settings.
+    """
+    chk = np.load(filename)
+    saved = dict(chk["settings"])
+    for key in sorted(settings):
+      if saved.get(key) != str(settings[key]):
+        raise ValueError("Checkpoint {} was written with {} = {}, not {}".format(filename, key, saved.get(key), settings[key]))
+    if chk["closedsum"].shape != self.closedsum.shape or not np.allclose(chk["histabcissae"], histabcissae):
+      raise ValueError("Checkpoint {} was written for a different k mesh or species selection".format(filename))
+    if int(chk["blocksize"]) != self.blocksize:
+      raise ValueError("Checkpoint {} uses blocks of {} frames, not {}".format(filename, int(chk["blocksize"]), self.blocksize))
+    self.closedsum = chk["closedsum"]
+    self.closeddegen = chk["closeddegen"]
+    if "blocksums" in chk.files:
+      for sums, degens in zip(chk["blocksums"], chk["blockdegens"]):
+        self.addBlock(sums, degens)
+      self.nclosed = len(chk["blockcounts"])
+    else:
+      self.nclosed = int(chk["nclosed"])
+      self.blockn = chk["blockn"]
+      self.blockmean = chk["blockmean"]
+      self.blockM2 = chk["blockM2"]
+    self.openshell = chk["openshell"]
+    self.opendegen = chk["opendegen"]
+    self.nopen = int(chk["nopen"])
+    self.SK[...] = 0.
+    self.nmesh = 0
+    return int(chk["nextframe"])
+
+
+def writeSKfiles(acc, header, histabcissae, natoms, columns):
+  """ Write the running S(k) average to sk.dat and, once there are two full blocks, its block-averaged standard errors to sk.err
+
+  columns gives the accumulator entry written in each column (e.g. the unpacked pairmap of packedPairs).
+  Shells that no wave vector has fallen into (possible with the fixed shells of --npt) are left out,
+  and sk.err also leaves out the shells that fewer than two full blocks reached.
+  """
+  keep = acc.degenSums() > 0
+  writeSK("sk.dat", header, acc.average(natoms)[columns][:,keep], histabcissae[keep])
+  err = acc.blockErrors(natoms)
+  if err is not None:
+    keep = np.all(np.isfinite(err), axis=0) # shells reached by fewer than two full blocks have no error bar
+    writeSK("sk.err", header, err[columns][:,keep], histabcissae[keep])
+
+
+class RhoStore(object):
+  """ Per-frame complex rho_i(k) of a subset of wave vectors, in a memory-mapped .npy file
+
+  The file is k-major, [nk, nspec, T], so the time series of a tile of wave vectors is one contiguous
+  read for collectiveFkt. Frame iframe of the trajectory goes to column (iframe-first)/stride, so worker
+  processes can each fill their own range of columns. Consecutive frames are buffered in memory and
+  written in slabs of up to RHOBUFBYTES, rather than one scattered element per row and frame.
+  The file is opened lazily, and neither it nor the buffer is pickled with the object.
+  """
+
+  def __init__(self, filename, kselect, first, stride):
+    self.filename = filename
+    self.kselect = kselect
+    self.first = first
+    self.stride = stride
+    self.rho = None
+    self.buffer = []
+    self.bufstart = self.bufend = 0
+
+  def create(self, nframes, nspec, resume=False):
+    """ Allocate the file for nframes frames, or with resume reopen an existing one, extended if the trajectory has grown
+
+    Raises ValueError if the file to resume holds other species or wave vectors.
+    """
+    shape = (len(self.kselect), nspec, nframes)
+    if resume and os.path.exists(self.filename):
+      old = np.lib.format.open_memmap(self.filename, mode='r')
+      if old.shape[:2] != shape[:2] or old.shape[2] > nframes:
+        raise ValueError("{} holds rho for {} (k, species, frames), not {}".format(self.filename, old.shape, shape))
+      if old.shape[2] == nframes:
+        self.rho = np.lib.format.open_memmap(self.filename, mode='r+')
+        return
+      tmpname = self.filename + ".tmp.npy"
+      self.rho = np.lib.format.open_memmap(tmpname, mode='w+', dtype=np.complex64, shape=shape)
+      for k in range(shape[0]):
+        self.rho[k,:,:old.shape[2]] = old[k]
+      del old
+      self.rho.flush()
+      os.rename(tmpname, self.filename)
+    else:
+      self.rho = np.lib.format.open_memmap(self.filename, mode='w+', dtype=np.complex64, shape=shape)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["rho"] = None
+    state["buffer"] = []
+    return state
+
+  def write(self, iframe, rho):
+    column = (iframe - self.first)//self.stride
+    if self.buffer and column != self.bufend:
+      self.flush()
+    if not self.buffer:
+      self.bufstart = self.bufend = column
+    self.buffer.append(rho[:,:,self.kselect].astype(np.complex64))
+    self.bufend += len(rho)
+    if (self.bufend - self.bufstart)*self.buffer[0][0].nbytes >= RHOBUFBYTES:
+      self.flush()
+
+  def flush(self):
+    """ Write the buffered frames and flush the file """
+    if self.buffer:
+      if self.rho is None:
+        self.rho = np.lib.format.open_memmap(self.filename, mode='r+')
+      self.rho[:,:,self.bufstart:self.bufend] = np.transpose(np.concatenate(self.buffer), (2,1,0))
+      self.buffer = []
+    if self.rho is not None:
+      self.rho.flush()
+
+
+def collectiveFkt(rho, kweights, kshell, nshell, pairs, natoms):
+  """ Collective intermediate scattering function F_ij(k,t) for all lags, by FFT correlation
+
+  F_ij(k,t) = < rho_i(k,t0+t) conj(rho_j(k,t0)) > / natoms, averaged over the time origins t0 and
+  the wave vectors of each shell, and symmetrized in (i, j) (i.e. over t and -t); at t=0 this is S_ij(k).
+  Each time series is zero padded to 2T, so the correlation over all T lags costs O(T log T)
+  instead of O(T^2). Wave vectors are processed in tiles, each a contiguous block of the k-major
+  rho, so rho may be a memory map.
+
+  Parameters
+  ----------
+  rho : nparray
+      complex rho_i(k), [nk, nspec, T]
+  kweights : nparray
+      number of full-mesh points each wave vector stands for, [nk]
+  kshell : nparray
+      0-based shell of each wave vector, [nk]
+  nshell : int
+      number of shells
+  pairs : list
+      0-based species pairs (i, j)
+  natoms : int
+      number of atoms
+
+  Returns
+  -------
+  nparray
+      Fkt, [len(pairs), nshell, T]
+  """
+  nk, nspec, T = rho.shape
+  n = int(2**np.ceil(np.log2(max(2*T-1, 1))))
+  ktile = max(1, FKTBYTES//(16*n*nspec))
+  shellmatrix = np.zeros([nk, nshell])
+  shellmatrix[np.arange(nk), kshell] = kweights
+  Fkt = np.zeros([len(pairs), nshell, T])
+  for k0 in range(0, nk, ktile):
+    k1 = min(k0+ktile, nk)
+    A = np.fft.fft(np.asarray(rho[k0:k1], dtype=complex), n=n, axis=2) # [ktile, nspec, n]
+    for p,(i,j) in enumerate(pairs):
+      c = np.fft.ifft(A[:,i]*np.conj(A[:,j]), axis=1).real # c[t] for lags t >= 0, c[n-t] for -t
+      csym = 0.5*(c[:,:T] + np.concatenate([c[:,:1], c[:,n-1:n-T:-1]], axis=1))
+      Fkt[p] += np.matmul(shellmatrix[k0:k1].T, csym)
+  norigins = T - np.arange(T)
+  degen = np.sum(shellmatrix, axis=0)
+  return Fkt/degen[:,None]/norigins/natoms
+
+
+def writeFkt(filename, Fkt, columns, labels, shellk, dt):
+  """ Write F(k,t), one row per lag (in trajectory frames, dt per lag) and one column per (shell, entry of columns) """
+  Fkt = Fkt[columns] # [ncol, nshell, T]
+  fktfile = open(filename,"w")
+  fktfile.write("# t " + " ".join(["{}(k={})".format(l, k) for k in shellk for l in labels]) + "\n")
+  for t in range(Fkt.shape[-1]):
+    fktfile.write("{} {}\n".format(t*dt, " ".join(["{}".format(v) for v in np.transpose(Fkt[:,:,t]).ravel()])))
+  fktfile.close()
+
 
 if __name__ == "__main__":
   parser = ap.ArgumentParser(description='Structure factor generator')
@@ -360,23 +1307,71 @@ if __name__ == "__main__":
   parser.add_argument('-i', '--spec1',  action='store',type=int,default=-1,help='First species for S_{ij}(k)')
   parser.add_argument('-j', '--spec2',  action='store',type=int,default=-1,help='Second species for S_{ij}(k)')
   parser.add_argument('-s', '--skip',   action='store',type=int,default=1,help='Number of time frames to skip (e.g., warmup)')
+  parser.add_argument('--stride', action='store',type=int,default=1,help='Use every stride-th frame after the skipped ones')
+  parser.add_argument('--chunk', action='store',type=int,default=100,help='Number of frames read from the trajectory at a time')
   parser.add_argument('-t', '--trjfile', action='store',type=str,default='output.nc',help='trajectory file')
   parser.add_argument('-p', '--topfile', action='store',type=str,default='top.pdb',help='topology file')
+  parser.add_argument('--format', action='store',type=str, default = 'auto', choices=['auto','mdtraj','lammps'], help = 'trajectory reader: mdtraj, the native LAMMPS text dump reader, or auto (native for dump.* and *.dump files, mdtraj otherwise); the native reader keeps the lengths of the dump (e.g. A) and uses the LAMMPS atom types as species, ignoring -p')
   parser.add_argument('--pruneRes', action='store',type=float, default = 0, help = 'pruning bin resolution')
-  parser.add_argument('--pruneNum', action='store',type=int, default = 50, help = 'max number of wave vectors for each pruned bin')
+  parser.add_argument('--pruneNum', action='store',type=int, default = 50, help = 'target number of wave vectors for each pruned bin')
+  parser.add_argument('--pruneSeed', action='store',type=int, default = 0, help = 'random seed of the pruning, so that the pruned mesh is reproducible')
+  parser.add_argument('--nblock', action='store',type=int, default = 1, help = 'number of frames processed together by the vectorized S(k) engine')
+  parser.add_argument('--error-block', dest='errorBlock', action='store',type=int, default = 10, help = 'frames per block for the block-averaged standard errors in sk.err')
+  parser.add_argument('--checkpoint', action='store',type=str, default = 'sk.chk.npz', help = 'binary checkpoint of the accumulated sums, written with sk.dat')
+  parser.add_argument('--resume', action='store_true', help = 'continue from the checkpoint instead of starting over')
+  parser.add_argument('--nprocs', action='store',type=int, default = 1, help = 'number of worker processes, each streaming contiguous ranges of frames')
+  parser.add_argument('--write-every', dest='writeEvery', action='store',type=int, default = None, help = 'rewrite sk.dat and the checkpoint every this many frames; with --nprocs, after each shard of about this many frames (default: every 10 chunks, 0: only at the end)')
+  parser.add_argument('--fullspace', action='store_true', help = 'use both k and -k instead of the half-space mesh (S(k) = S(-k), so the result is the same at twice the cost)')
+  parser.add_argument('--engine', action='store',type=str, default = 'direct', choices=['direct','pm'], help = 'S(k) engine: direct sum over atoms and k vectors, or particle-mesh FFT (faster for dense k meshes)')
+  parser.add_argument('--pm-grid', dest='pmGrid', action='store',type=int, default = 0, help = 'grid points per axis for the particle-mesh engine (default: 4x oversampling of the k mesh, power of two)')
+  parser.add_argument('--pm-order', dest='pmOrder', action='store',type=str, default = 'tsc', choices=['cic','tsc'], help = 'particle-mesh assignment scheme')
+  parser.add_argument('--pm-check', dest='pmCheck', action='store_true', help = 'time the particle-mesh engine against the direct engine on the first frame and report its accuracy (the direct engine is costly on dense meshes)')
+  parser.add_argument('--tile-size', dest='tileSize', action='store',type=str, default = None, help = 'working set of one exp(ik.r) phase tile of the S(k) engine, e.g. 512KB or 64MB; this sizes the tiles only, not the total memory of the run (default: 2MiB, cache-sized)')
+  parser.add_argument('--fkt', action='store',type=float, nargs='+', default=None, help = '|k| of the shells (nearest to each value) whose per-frame rho is saved to compute F(k,t)')
+  parser.add_argument('--fkt-file', dest='fktFile', action='store',type=str, default = 'rho.npy', help = 'memory-mapped file for the per-frame rho of the --fkt shells')
+  parser.add_argument('--residues', action='store',type=str, default = None, choices=['com','cog'], help = 'compute S(k) of the residue centres of mass (com) or geometric centres (cog) instead of the atoms; the species are then the residue names')
+  parser.add_argument('--plane', action='store',type=str, default = None, choices=['x','y','z'], help = 'restrict the k mesh to the plane normal to this axis, e.g. z for the in-plane S(q_xy) of an interface')
+  parser.add_argument('--npt', action='store_true', help = 'the box changes during the run: rebuild the k mesh for each new box and bin |k| into fixed shells')
+  parser.add_argument('--kbin', action='store',type=float, default = 0., help = 'width of the fixed |k| shells with --npt (default: 2pi/L for the largest box length of the first frame)')
+  parser.add_argument('--box-tol', dest='boxTol', action='store',type=float, default = 1.e-6, help = 'relative change of a box length below which the k mesh is reused')
 
   sphcut = True # Use a spherical kmesh
 
   # === Parse the input options ===
   args = parser.parse_args()
+  if args.writeEvery is None:
+    args.writeEvery = 10*args.chunk # checkpoint periodically, so a killed job keeps most of its frames
   print( "Parameters: " )
   print( " - Species = {}, {}".format(args.spec1,args.spec2) )
   print( " - Skip frames = {}".format(args.skip) )
+  print( " - Stride = {}".format(args.stride) )
+  print( " - Chunk = {}".format(args.chunk) )
   print( " - kcutoff = {}".format(args.kmax) )
   print( " - trjfile = {}".format(args.trjfile) )
   print( " - topfile = {}".format(args.topfile) )
+  print( " - format = {}".format(args.format) )
   print( " - pruneRes = {}".format(args.pruneRes) )
   print( " - pruneNum = {}".format(args.pruneNum) )
+  print( " - pruneSeed = {}".format(args.pruneSeed) )
+  print( " - nblock = {}".format(args.nblock) )
+  print( " - errorBlock = {}".format(args.errorBlock) )
+  print( " - checkpoint = {}".format(args.checkpoint) )
+  print( " - resume = {}".format(args.resume) )
+  print( " - nprocs = {}".format(args.nprocs) )
+  print( " - writeEvery = {}".format(args.writeEvery) )
+  print( " - fullspace = {}".format(args.fullspace) )
+  print( " - engine = {}".format(args.engine) )
+  print( " - pmGrid = {}".format(args.pmGrid) )
+  print( " - pmOrder = {}".format(args.pmOrder) )
+  print( " - pmCheck = {}".format(args.pmCheck) )
+  print( " - tileSize = {}".format(args.tileSize) )
+  print( " - fkt = {}".format(args.fkt) )
+  print( " - fktFile = {}".format(args.fktFile) )
+  print( " - residues = {}".format(args.residues) )
+  print( " - plane = {}".format(args.plane) )
+  print( " - npt = {}".format(args.npt) )
+  print( " - kbin = {}".format(args.kbin) )
+  print( " - boxTol = {}".format(args.boxTol) )
 
   # Demand that both spec1 and spec2 are positive or negative.
   # Negative means full matrix, positive means that we are producing a specific pair.
@@ -387,31 +1382,78 @@ if __name__ == "__main__":
   if args.spec1 < 0:
     fullMatrix = True
 
-  # === Load Trajectory ===
-  top = md.load(args.topfile).top
-  traj = md.load(args.trjfile, top=top)
-  natoms = top.n_atoms
-
-  types = set([a.name for a in top.atoms])
-  typedict = {}
-  for it,t in enumerate(types):
-    typedict[t] = it+1
-  nspec = len(types)
+  # === Open Trajectory ===
+  # Frames are streamed in chunks in the main loop; only the first used frame is read here for the box
+  if args.format == 'lammps' or (args.format == 'auto' and isLammpsDump(args.trjfile)):
+    # Native reader: the species are the LAMMPS atom types, and lengths stay in the units of the dump
+    try:
+      trj = LammpsDump(args.trjfile)
+      ntrjframes = countFrames(trj)
+      if args.skip >= ntrjframes:
+        print( "Skip = {} is past the last frame of {} ({} frames)".format(args.skip, args.trjfile, ntrjframes) )
+        quit()
+      xyz0, boxes0, types = trj.readFrames([args.skip])
+    except ValueError as err:
+      print(err)
+      quit()
+    if args.residues is not None:
+      print( "Residue centres need a topology, and are not available for LAMMPS dumps" )
+      quit()
+    top = None
+    residues = None
+    natoms = trj.natoms
+    nspec = int(np.max(types))
+    typedict = dict([(t, t) for t in range(1, nspec+1)])
+    specidx = types - 1
+    box = boxes0[0]
+    print( "Native LAMMPS dump reader: {} frames, {} atoms, {} atom types".format(len(trj), natoms, nspec) )
+    print( " lengths (and so kmax and |k|) are in the units of the dump, species are the LAMMPS atom types; topology {} is not used".format(args.topfile) )
+  else:
+    trj = args.trjfile
+    print( "Reading {} with mdtraj, species from topology {}".format(args.trjfile, args.topfile) )
+    top = md.load(args.topfile).top
+    # Counting frames can mean reading the whole file (see countFrames), so it is only done when the
+    # F(k,t) store or the frame shards need the total; otherwise a skip past the end shows up on reading
+    ntrjframes = None
+    if args.fkt is not None or args.nprocs > 1:
+      ntrjframes = countFrames(trj, top, args.chunk)
+      if args.skip >= ntrjframes:
+        print( "Skip = {} is past the last frame of {} ({} frames)".format(args.skip, args.trjfile, ntrjframes) )
+        quit()
+    try:
+      frame0 = md.load_frame(args.trjfile, args.skip, top=top)
+    except (IndexError, IOError):
+      frame0 = None
+    if frame0 is None or frame0.n_frames == 0:
+      print( "Skip = {} is past the last frame of {}".format(args.skip, args.trjfile) )
+      quit()
+    natoms = top.n_atoms
+
+    residues = None
+    if args.residues is not None:
+      # The residue centres stand in for the atoms from here on, with the residue names as species
+      residues = residueMap(top, args.residues)
+      natoms = residues[3]
+      types = set([r.name for r in top.residues])
+      print( "S(k) of {} residue centres ({})".format(natoms, args.residues) )
+    else:
+      types = set([a.name for a in top.atoms])
+    typedict = {}
+    for it,t in enumerate(types):
+      typedict[t] = it+1
+    nspec = len(types)
+    if residues is not None:
+      specidx = np.array([typedict[r.name]-1 for r in top.residues], dtype=int)
+      xyz0 = residueCentres(frame0.xyz, frame0.unitcell_lengths, residues)
+    else:
+      specidx = speciesIndex(top, typedict)
+      xyz0 = frame0.xyz
 
-  Lmin = 0
-  Lmax = traj[0].unitcell_lengths[0][0] #assuming cubic for now
+    box = np.array(frame0.unitcell_lengths[0], dtype=np.float64) # (Lx, Ly, Lz)
+    if np.any(np.abs(frame0.unitcell_angles[0] - 90.) > 1.e-3):
+      print( "Triclinic boxes are not supported yet, box angles = {}".format(frame0.unitcell_angles[0]) )
+      quit()
 
-  '''
-  # === Read File for Metadata ===
-  error, status, info = lammpsHeaderInfo(args.file)
-  if error:
-    print(status)
-    quit()
-  nspec = info["nspec"]
-  natoms = info["natoms"]
-  Lmin = info["Lmin"]
-  Lmax = info["Lmax"]
-  '''
   if args.spec1 > nspec or args.spec2 > nspec:
     print( "Specified species index exceeds maximum found in coords file" )
     print( "i = {}, j = {}, nspec = {}".format(args.spec1, args.spec2, nspec ))
@@ -420,114 +1462,221 @@ if __name__ == "__main__":
 
   # === Prepare k mesh ===
   print("Preparing k mesh")
-  kmesh3d, modklist, nk3d = generateKmesh(Lmax - Lmin, args.kmax, PosOctant=False, PosOnly=False, SphCut=False)
-  # === Possibly prune the k-vector list ===
-  # with histabcissae, can better assess what magnitudes to prune from
-  # after pruning, get new kmesh3d, modklist, nk3d; then get new histmapper, histabcissae, histndegen, sortindex3d
-  # decides what to prune by making sure that # of points in each `resolution` bin has < 100 points
-  #
-  if args.pruneRes > 0.0:
-      print("Pruning kmesh because too many...")
-      kmesh3d, modklist, nk3d = pruneKmesh( kmesh3d, modklist, resolution = args.pruneRes, n_per_bin = args.pruneNum )
-
-
-  # === Generate the histogram mapping ===
-  # TODO:
-  #   It would be better to invert the map (as in PolyFTS) so that referencing the
-  #   histogram index returns a list of 3d mesh points that map to it, then we will not need
-  #   to store S(k) on the full mesh
-  print("Generating histogram mapping")
-  histmapper, histabcissae, histndegen, sortindex3d, orderedVecList = histogrammapping(kmesh3d, modklist, debug=False)
+  meshcache = None
+  normal = None if args.plane is None else "xyz".index(args.plane)
+  if args.npt:
+    # The mesh follows the box and is cached between box changes; shells are fixed |k| bins
+    kbin = args.kbin if args.kbin > 0. else 2*np.pi/np.max(box)
+    prune = (args.pruneRes, args.pruneNum, args.pruneSeed) if args.pruneRes > 0.0 else None
+    meshcache = KmeshCache(args.kmax, kbin, args.boxTol, HalfSpace=not args.fullspace, engine=args.engine, pmgrid=args.pmGrid, prune=prune, Normal=normal)
+    meshcache.update(box)
+    kmesh3d, nk3d, kweights, shellmap = meshcache.kmesh3d, meshcache.nk3d, meshcache.kweights, meshcache.shellmap
+    histabcissae = meshcache.histabcissae
+    nshell = meshcache.nshell
+    print("Fixed |k| shells of width {}".format(kbin))
+  else:
+    kmesh3d, modklist, nk3d = generateKmesh(box, args.kmax, PosOctant=False, PosOnly=False, SphCut=False, HalfSpace=not args.fullspace, Normal=normal)
+    # === Possibly prune the k-vector list ===
+    # with histabcissae, can better assess what magnitudes to prune from
+    # after pruning, get new kmesh3d, modklist, nk3d; then get new histmapper, histabcissae, histndegen, sortindex3d
+    # decides what to prune by making sure that # of points in each `resolution` bin is about pruneNum,
+    # reweighting the kept vectors so that every shell keeps its full degeneracy
+    #
+    if args.fullspace:
+      kweights = np.ones(nk3d, dtype=int)
+    else:
+      kweights = halfSpaceWeights(kmesh3d)
+    if args.pruneRes > 0.0:
+        print("Pruning kmesh because too many...")
+        kmesh3d, modklist, nk3d, kweights = pruneKmesh( kmesh3d, modklist, resolution = args.pruneRes, n_per_bin = args.pruneNum, weights = kweights, seed = args.pruneSeed )
+
+
+    # === Generate the histogram mapping ===
+    # The map is also inverted (as in PolyFTS): shellstart gives the range of sortindex3d holding
+    # the 3d mesh points of each histogram index
+    print("Generating histogram mapping")
+    histmapper, histabcissae, histndegen, sortindex3d, shellstart = histogrammapping(kmesh3d, modklist, weights=kweights, debug=False)
+    # Histogram (shell) index of each 3d mesh point, for the bincount reduction
+    nshell = len(histabcissae)
+    shellmap = np.empty(nk3d, dtype=int)
+    shellmap[sortindex3d] = histmapper
 
   #exit()
 
   # === Initialize the structure factor ===
   if fullMatrix:
-    SK = np.zeros([nspec,nspec,nk3d]) # TODO: exploit symmetry in species indices - a packed storage format with mapping
+    SKshape = (nspec*(nspec+1)//2,nk3d) # S_ij = S_ji: packed upper triangle, unpacked to all nspec^2 columns on output
+    columns = packedPairs(nspec).ravel()
+    header = "# |k|"
+    labels = []
+    for i in range(nspec):
+      for j in range(nspec):
+        header += " S{}{}(k)".format(i+1,j+1)
+        labels.append("F{}{}".format(i+1,j+1))
+    header += "\t TypeMap: {}\n".format(typedict) #species mapping
   else:
-    SK = np.zeros([1,1,nk3d])
-  SKnavg = 0
+    SKshape = (1,nk3d)
+    columns = [0]
+    header = " S{}{}(k)\n".format(args.spec1,args.spec2)
+    labels = ["F{}{}".format(args.spec1,args.spec2)]
+  acc = SKAccumulator(SKshape, shellmap, kweights, nshell, args.errorBlock)
+
+  # === Possibly resume from a checkpoint ===
+  # A checkpoint only continues a run over the same frames and species pair
+  chksettings = {"trjfile":os.path.abspath(args.trjfile), "skip":args.skip, "stride":args.stride,
+                 "pair":"all" if fullMatrix else (args.spec1, args.spec2), "residues":args.residues}
+  firstframe = args.skip
+  if args.resume:
+    if os.path.exists(args.checkpoint):
+      try:
+        firstframe = acc.load(args.checkpoint, histabcissae, chksettings)
+      except ValueError as err:
+        print(err)
+        quit()
+      print("Resuming from {}: {} frames accumulated, continuing at frame {}".format(args.checkpoint, acc.nframes, firstframe))
+    else:
+      print("No checkpoint {} found, starting from frame {}".format(args.checkpoint, firstframe))
+
+  # === Possibly keep the per-frame rho of some shells for F(k,t) ===
+  rhostore = None
+  if args.fkt is not None:
+    if args.npt:
+      print( "F(k,t) needs a fixed k mesh, and is not supported with --npt" )
+      quit()
+    if firstframe > args.skip and not os.path.exists(args.fktFile):
+      print( "Cannot resume F(k,t) without the rho of the frames already accumulated in {}".format(args.fktFile) )
+      quit()
+    fktshells = np.unique([1 + np.argmin(np.abs(histabcissae[1:] - k)) for k in args.fkt])
+    kselect = np.flatnonzero(np.isin(shellmap, fktshells))
+    print("F(k,t) for shells |k| = {} ({} wave vectors), rho saved in {}".format(histabcissae[fktshells], len(kselect), args.fktFile))
+    rhostore = RhoStore(args.fktFile, kselect, args.skip, args.stride)
+    try:
+      rhostore.create(len(range(args.skip, ntrjframes, args.stride)), nspec, resume=firstframe > args.skip)
+    except ValueError as err:
+      print(err)
+      quit()
 
 
   # === Loop ===
   print("Starting Loop and Calculations")
 
-  iframe = 0
-  pcoord = np.zeros([3])
+  # exp(ik.r) is built with the Ewald-style recurrence; a pruned k set still lies on the lattice,
+  # and the per-atom power tables are much cheaper than one cos/sin per (atom, k) pair
+  dk = 2*np.pi/box
+  kindex = latticeIndex(kmesh3d, dk)
+  if kindex is None:
+    print("The k set is not on the integer lattice of the box")
+    quit()
+
+  tileBytes = None
+  if args.tileSize is not None:
+    tileBytes = parseMemory(args.tileSize)
+  print( "Phase tiles (frames, atoms, k) = {}".format(chooseTiles(args.nblock, natoms, nk3d, tileBytes, RECBYTES)) )
+  if args.engine == 'direct':
+    # Report the round-off accumulated by the recurrence against the direct cos/sin reference, on the first frame
+    rhorec = SKengine(xyz0, kmesh3d, specidx, nspec, tileBytes, kindex, dk)
+    rhodirect = SKengine(xyz0, kmesh3d, specidx, nspec, tileBytes)
+    print(" Recurrence accuracy vs direct cos/sin: max |drho| = {}, max |drho|/natoms = {}".format(np.max(np.abs(rhorec-rhodirect)), np.max(np.abs(rhorec-rhodirect))/natoms))
+
+  pair = None if fullMatrix else (args.spec1-1, args.spec2-1)
+  setup = {"trjfile":trj, "top":top, "stride":args.stride, "chunk":args.chunk, "nblock":args.nblock,
+           "SKshape":SKshape, "kmesh3d":kmesh3d, "specidx":specidx, "nspec":nspec,
+           "shellmap":shellmap, "kweights":kweights, "nshell":nshell, "blocksize":args.errorBlock,
+           "tileBytes":tileBytes, "kindex":kindex, "dk":dk, "pair":pair, "engine":args.engine,
+           "meshcache":meshcache, "box":box, "boxtol":args.boxTol, "boxwarned":False, "rhostore":rhostore, "residues":residues}
+  if args.engine == 'pm':
+    klattice = latticeIndex(kmesh3d, dk)
+    if klattice is None:
+      print("The particle-mesh engine needs a k set on the integer lattice")
+      quit()
+    pmgrid = args.pmGrid if args.pmGrid > 0 else pmGridSize(klattice)
+    if 2*np.max(np.abs(klattice)) >= pmgrid:
+      print("PM grid of {} points cannot resolve lattice offsets up to {}".format(pmgrid, np.max(np.abs(klattice))))
+      quit()
+    setup.update({"L":box, "klattice":klattice, "pmgrid":pmgrid, "pmorder":PMORDER[args.pmOrder]})
+    print("Particle-mesh engine: {}^3 grid, {} assignment".format(pmgrid, args.pmOrder))
+    if args.pmCheck:
+      # Benchmark against the direct engine on the first frame, so the crossover for this system is visible
+      tpm = timeit.default_timer()
+      rhopm = rhoFrames(xyz0, setup)
+      tpm = timeit.default_timer() - tpm
+      tdirect = timeit.default_timer()
+      rhodirect = SKengine(xyz0, kmesh3d, specidx, nspec, tileBytes, kindex, dk)
+      tdirect = timeit.default_timer() - tdirect
+      print(" PM engine: {} s/frame, direct engine: {} s/frame".format(tpm, tdirect))
+      print(" PM accuracy vs direct: max |drho|/natoms = {}".format(np.max(np.abs(rhopm-rhodirect))/natoms))
+
   start = timeit.default_timer()
-  for iframe,frame in enumerate(traj):
-    print("Processing frame {}".format(iframe))
-
-    CI = np.zeros([nspec,nk3d])
-    SI = np.zeros([nspec,nk3d])
-
-    # == Calculate the wave vector contributions ==  
-    for atomidx in range(natoms):
-      if iframe < args.skip:
-        continue
-      pcoord = frame.xyz[0][atomidx]
-      spec = typedict[top.atom(atomidx).name]
-      # Generate the cos(kr) and sin(kr) entries
-      #  currently do this whether or not the species is used so that we don't need to
-      #  store in separate arrays (CI, CJ) when computing a single off-diagonal element of S(k)
-      kdotr = np.dot(kmesh3d,pcoord)
-      CI[spec-1] += np.cos(kdotr)
-      SI[spec-1] += np.sin(kdotr)
-
-    # == Accumulate results by wave vector magnitude, collect in average ==
-    # first calculate Sk[i][j] += cos[i]*cos[j] + sin[i]*sin[j]
-    # then accumulate those with common wave-vector magnitude into SKhist
-    # then normalize SKhist by degeneracy, # frames, and #atoms
-    # 
-    if iframe >= args.skip:
-      SKnavg += 1
-      skfile = open("sk.dat","w")
-      #sk3dfile = open("sk3d.dat","w")
-      if fullMatrix:
-        skfile.write("# |k|")
-        for i in range(nspec):
-          for j in range(nspec):
-            skfile.write(" S{}{}(k)".format(i+1,j+1)) #part of header
-            SK[i][j] += CI[i]*CI[j] + SI[i]*SI[j]
-        skfile.write("\t TypeMap: {}".format(typedict)) #species mapping
-        skfile.write("\n")
-
-        SKhist=np.zeros([nspec,nspec,len(histabcissae)])
-        for i in range(nspec):
-          for j in range(nspec):
-            for ik in range(nk3d):
-              SKhist[i][j][histmapper[ik]] += SK[i][j][sortindex3d[ik]]
-
-        # Write
-        for ik in range(1,len(histabcissae)): # Start at idx=1 -- miss k=0
-          skfile.write("{}".format(histabcissae[ik]))
-          for i in range(nspec):
-            for j in range(nspec):
-              skfile.write(" {}".format(SKhist[i][j][ik]/histndegen[ik]/SKnavg/natoms))
-          skfile.write("\n")
-      else:
-        if args.spec1 == args.spec2:
-          skfile.write(" S{}{}(k)\n".format(args.spec1,args.spec1))
-          SK[0][0] += np.square(CI[args.spec1-1]) + np.square(SI[args.spec1-1])
-        else:
-          skfile.write(" S{}{}(k)\n".format(args.spec1,args.spec2))
-          SK[0][0] += CI[args.spec1-1]*CI[args.spec2-1] + SI[args.spec1-1]*SI[args.spec2-1]
-
-        SKhist=np.zeros([len(histabcissae)])
-        for ik in range(nk3d):
-          SKhist[histmapper[ik]] += SK[0][0][sortindex3d[ik]]
-        for ik in range(1,len(histabcissae)): # Start at idx=1 -- miss k=0
-          skfile.write("{} {}\n".format(histabcissae[ik], SKhist[ik]/histndegen[ik]/SKnavg/natoms))
-      
-      #for ik in range(nk3d):
-      #  sk3dfile.write("{} {}\n".format(np.linalg.norm(kmesh3d[ik]), SK[0][0][ik]/SKnavg/natoms))
-
-      skfile.close()
-
-      print( ' Average time / frame: {}'.format((timeit.default_timer() - start) / (iframe-args.skip+1)) )
-
-  # === Print out degeneracies, so that we can average different wave-vector points together === #
-  metadata = np.vstack([histabcissae, histndegen])
+  nstart = acc.nframes
+  if args.nprocs > 1:
+    # == Shard the used frames into contiguous ranges aligned to the error blocks ==
+    # The first shard completes the error block left open by a resumed checkpoint. With --write-every,
+    # shards hold at most about that many frames, and sk.dat and the checkpoint are written as each one is merged
+    nused = len(range(firstframe, ntrjframes, args.stride))
+    lead = min((args.errorBlock - acc.nopen) % args.errorBlock, nused)
+    nblocks = -(-(nused - lead)//args.errorBlock)
+    nshards = args.nprocs
+    if args.writeEvery > 0:
+      nshards = max(nshards, -(-nblocks//max(args.writeEvery//args.errorBlock, 1)))
+    counts = [args.errorBlock*(nblocks//nshards + (1 if w < nblocks%nshards else 0)) for w in range(nshards)]
+    counts[0] += lead
+    counts = list(np.diff(np.minimum(np.cumsum([0]+counts), nused)))
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    shards = [(firstframe + int(offsets[w])*args.stride, int(counts[w]), acc.nopen if w == 0 else 0) for w in range(nshards) if counts[w] > 0]
+    print("Distributing {} frames over {} processes in {} shards".format(nused, min(args.nprocs, len(shards)), len(shards)))
+    if len(shards) > 0:
+      pool = multiprocessing.Pool(min(args.nprocs, len(shards)), initializer=initSKworker, initargs=(setup,))
+      # Deterministic reduction, in shard order
+      for shard, (part, nbuild) in zip(shards, pool.imap(SKworker, shards, chunksize=1)):
+        acc.merge(part)
+        if meshcache is not None:
+          meshcache.nbuild += nbuild
+        if args.writeEvery > 0:
+          writeSKfiles(acc, header, histabcissae, natoms, columns)
+          acc.save(args.checkpoint, shard[0] + shard[1]*args.stride, histabcissae, chksettings)
+      pool.close()
+      pool.join()
+    nextframe = firstframe + nused*args.stride
+    print( ' Average time / frame: {}'.format((timeit.default_timer() - start) / max(acc.nframes-nstart,1)) )
+  else:
+    nextframe = firstframe
+    for iframe, xyz, boxes in iterFrames(trj, top, firstframe, args.stride, args.chunk, args.nblock):
+      print("Processing frames {}-{}".format(iframe, iframe+(len(xyz)-1)*args.stride))
+
+      # == Calculate the wave vector contributions for the whole block and accumulate them ==
+      # first calculate Sk[i][j] += cos[i]*cos[j] + sin[i]*sin[j]
+      # then, at block ends and mesh changes, accumulate those with common wave-vector magnitude into the shell sums
+      # and at checkpoints normalize by the accumulated degeneracy (# mesh points x # frames), and #atoms
+      # 
+      processBlock(acc, iframe, xyz, boxes, setup)
+      nextframe = iframe + len(xyz)*args.stride
+
+      if args.writeEvery > 0 and (acc.nframes//args.writeEvery) > ((acc.nframes-len(xyz))//args.writeEvery):
+        writeSKfiles(acc, header, histabcissae, natoms, columns)
+        if rhostore is not None:
+          rhostore.flush() # rho of every accumulated frame must be on disk before the checkpoint
+        acc.save(args.checkpoint, nextframe, histabcissae, chksettings)
+
+      print( ' Average time / frame: {}'.format((timeit.default_timer() - start) / (acc.nframes-nstart)) )
+
+  writeSKfiles(acc, header, histabcissae, natoms, columns)
+  acc.save(args.checkpoint, nextframe, histabcissae, chksettings)
+
+  if meshcache is not None:
+    print("k mesh built for {} different boxes".format(meshcache.nbuild))
+
+  # === Collective F(k,t) from the saved rho, all lags at once ===
+  if rhostore is not None:
+    rhostore.flush()
+    start = timeit.default_timer()
+    pairs = list(zip(*np.triu_indices(nspec))) if fullMatrix else [pair]
+    kshell = np.searchsorted(fktshells, shellmap[kselect])
+    Fkt = collectiveFkt(rhostore.rho, kweights[kselect], kshell, len(fktshells), pairs, natoms)
+    writeFkt("fkt.dat", Fkt, columns, labels, histabcissae[fktshells], args.stride)
+    print("F(k,t) for {} lags written to fkt.dat in {} s".format(Fkt.shape[-1], timeit.default_timer() - start))
+
+  # === Print out degeneracies (per frame), so that we can average different wave-vector points together === #
+  metadata = np.vstack([histabcissae, acc.degenSums()/max(acc.nframes,1)])
   np.savetxt('sk.metadat', metadata.T)
 
   
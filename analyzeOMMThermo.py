@@ -1,6 +1,6 @@
-import numpy as np
 import matplotlib.pyplot as plt
 import argparse as ap
+import datacache
 
 parser = ap.ArgumentParser(description="Analyze OpenMM Thermo log")
 parser.add_argument('file', type=str, help='thermo log filename')
@@ -9,7 +9,7 @@ args = parser.parse_args()
 print("Parsing...\n")
 print("Log file name \t {}".format(args.file))
 
-data = np.loadtxt(args.file, skiprows=1, delimiter=",")
+data = datacache.loadTable(args.file, skiprows=1, delimiter=",")[0]
 
 plt.plot(data[:,0],data[:,1]);plt.show()
 
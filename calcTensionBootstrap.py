@@ -3,6 +3,7 @@
 #
 import numpy as np
 import scipy
+import datacache
 from pymbar import MBAR, timeseries
 
 from parmed import gromacs
@@ -33,10 +34,11 @@ datafile = args.energy_file#'energies.txt'
 if args.energy_file.endswith('npy'):
     energies = np.load(args.energy_file)
 else:
+    # Parsed through the binary sidecar cache, so repeated bootstraps of the same file skip the text parse
     try:
-        energies =  np.loadtxt(datafile)
+        energies =  datacache.loadTable(datafile)[0]
     except:
-        energies =  np.loadtxt(datafile,delimiter=',')
+        energies =  datacache.loadTable(datafile,delimiter=',')[0]
 
 
 def calcTension(energy_data,verbose=False):
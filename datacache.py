@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Binary sidecar cache for parsed text data files (operators.dat, energies.txt, thermo logs, ...)
+#
+# The first load of <file> parses the text and writes two sidecars next to it:
+#   <file>.cache.npy   the full table, stored column-major so single columns can be memory-mapped
+#   <file>.cache.json  path, size and mtime of the source, the parse options, header lines and column names
+# Later loads only check the source's size and mtime against the metadata and memory-map the .npy.
+# A stale or unreadable cache is re-parsed; an unwritable directory just means no cache.
+import json
+import os
+import numpy as np
+
+def cachePaths(filename):
+    # Sidecar file names for a given source file
+    return filename+'.cache.npy', filename+'.cache.json'
+
+
+def readHeader(filehandler,skiprows=0,comments='#',delimiter=None):
+    # Header lines are the first skiprows lines plus any comment lines before the data.
+    # Column names are taken from the last header line, with comment marker and quotes stripped.
+    header=[]
+    while True:
+        line=filehandler.readline()
+        if len(line) == 0:
+            break
+        if len(header) < skiprows or line.lstrip().startswith(comments):
+            header.append(line.rstrip('\r\n'))
+        else:
+            break
+    names=[]
+    if len(header) > 0:
+        last=header[-1].lstrip()
+        if last.startswith(comments):
+            last=last[len(comments):]
+        names=[n.strip().strip('"\'') for n in last.split(delimiter)]
+        names=[n for n in names if len(n) > 0]
+    return header,names
+
+
+def sourceKey(filename,delimiter,skiprows):
+    # Everything that decides whether a cached table is still valid for this source
+    st=os.stat(filename)
+    return {'path':os.path.abspath(filename),'size':st.st_size,'mtime':st.st_mtime,
+            'delimiter':delimiter,'skiprows':skiprows}
+
+
+def loadCache(filename,key):
+    # Return (table,meta) from a valid cache, or None
+    npyfile,jsonfile=cachePaths(filename)
+    try:
+        with open(jsonfile,'r') as f:
+            meta=json.load(f)
+        for k in key:
+            if meta.get(k) != key[k]:
+                return None
+        return np.load(npyfile,mmap_mode='r'),meta
+    except (IOError,OSError,ValueError):
+        return None
+
+
+def writeCache(filename,key,table,header,names):
+    # Write both sidecars through temporary files, so a concurrent reader never sees half a cache.
+    # The .json is renamed last: it is what marks the cache valid.
+    npyfile,jsonfile=cachePaths(filename)
+    meta=dict(key)
+    meta['header']=header
+    meta['names']=names
+    meta['shape']=list(table.shape)
+    suffix='.tmp{0}'.format(os.getpid())
+    try:
+        with open(npyfile+suffix,'wb') as f:
+            np.save(f,np.asfortranarray(table))
+        with open(jsonfile+suffix,'w') as f:
+            json.dump(meta,f)
+        os.rename(npyfile+suffix,npyfile)
+        os.rename(jsonfile+suffix,jsonfile)
+    except (IOError,OSError):
+        for tmp in (npyfile+suffix,jsonfile+suffix):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+def defaultParser(filehandler,delimiter=None,skiprows=0,usecols=None):
+    return np.loadtxt(filehandler,delimiter=delimiter,skiprows=skiprows,usecols=usecols,ndmin=2)
+
+
+def cacheWritable(filename):
+    # Whether the sidecars can be written next to filename
+    return os.access(os.path.dirname(os.path.abspath(filename)),os.W_OK)
+
+
+def loadTable(filename,usecols=None,delimiter=None,skiprows=0,parser=None,cache=True):
+    # Load a 2D text table through the sidecar cache: returns (table,header,names)
+    # parser(filehandler,delimiter,skiprows,usecols) returns the [nrows,ncols] table of the columns usecols
+    # (all for None); np.loadtxt by default.
+    # The full table is only parsed when a sidecar is written. Otherwise (cache=False, or a directory
+    # we cannot write to) only the columns usecols are parsed and kept in memory.
+    # With usecols, only those columns are read from the memory-mapped cache and returned as an array.
+    if parser is None:
+        parser=defaultParser
+    key=sourceKey(filename,delimiter,skiprows)
+    cached=loadCache(filename,key) if cache else None
+    if cached is not None:
+        table,meta=cached
+        header,names=meta['header'],meta['names']
+    else:
+        write=cache and cacheWritable(filename)
+        with open(filename,'r') as f:
+            header,names=readHeader(f,skiprows,delimiter=delimiter)
+            f.seek(0)
+            table=np.atleast_2d(parser(f,delimiter,skiprows,None if write or usecols is None else list(usecols)))
+        if not write:
+            return table,header,names
+        writeCache(filename,key,table,header,names)
+    if usecols is not None:
+        table=table[:,list(usecols)]
+    return np.asarray(table),header,names
@@ -154,25 +154,32 @@ def statisticalInefficiency(A_n, B_n=None, fast=False, mintime=3):
     if(sigma2_AB == 0):
         logger.info('Sample covariance sigma_AB^2 = 0 -- cannot compute statistical inefficiency')
         return 1.0
-    # Accumulate the integrated correlation time by computing the normalized correlation time at
-    # increasing values of t.  Stop accumulating if the correlation function goes negative, since
-    # this is unlikely to occur unless the correlation function has decayed to the point where it
-    # is dominated by noise and indistinguishable from zero.
-    t = 1
-    increment = 1
-    while (t < N-1):
-        # compute normalized fluctuation correlation function at time t
-        C = sum( dA_n[0:(N-t)]*dB_n[t:N] + dB_n[0:(N-t)]*dA_n[t:N] ) / (2.0 * float(N-t) * sigma2_AB)
-        # Terminate if the correlation function has crossed zero and we've computed the correlation
-        # function at least out to 'mintime'.
-        if (C <= 0.0) and (t > mintime):
-            break
-        # Accumulate contribution to the statistical inefficiency.
-        g += 2.0 * C * (1.0 - float(t)/float(N)) * float(increment)
-        # Increment t and the amount by which we increment t.
-        t += increment
-        # Increase the interval if "fast mode" is on.
-        if fast: increment += 1
+    # Normalized fluctuation correlation function at every time t, from one zero-padded FFT
+    # (O(N log N) instead of a sum over the series for each t):
+    # sum_n dA[n]*dB[n+t] + dB[n]*dA[n+t] is the inverse transform of 2 Re(conj(FA)*FB).
+    nfft = int(2**np.ceil(np.log2(2*N-1))) if N > 1 else 1
+    FA = np.fft.rfft(dA_n, nfft)
+    FB = np.fft.rfft(dB_n, nfft)
+    t = np.arange(N)
+    C = np.fft.irfft(2.0 * (np.conj(FA) * FB).real, nfft)[:N] / (2.0 * (N-t) * sigma2_AB)
+    # Times at which the correlation function is sampled, with the spacing by which each one counts:
+    # every t, or in "fast mode" an interval increased by one after each sample (t = 1, 2, 4, 7, 11, ...).
+    if fast:
+        increment = np.arange(1, int(np.sqrt(2.0*N))+2)
+        t = 1 + np.concatenate([[0], np.cumsum(increment[:-1])])
+    else:
+        increment = np.ones(N, dtype=int)
+        t = 1 + np.arange(N)
+    keep = t < N-1
+    t, increment = t[keep], increment[keep]
+    C = C[t]
+    # Accumulate the integrated correlation time up to the first time the correlation function goes
+    # negative after 'mintime', since this is unlikely to occur unless the correlation function has
+    # decayed to the point where it is dominated by noise and indistinguishable from zero.
+    stop = np.flatnonzero((C <= 0.0) & (t > mintime))
+    if stop.size > 0:
+        t, increment, C = t[:stop[0]], increment[:stop[0]], C[:stop[0]]
+    g += np.sum(2.0 * C * (1.0 - t.astype(np.float64)/float(N)) * increment)
     # g must be at least unity
     if (g < 1.0): g = 1.0
     # Return the computed statistical inefficiency.
@@ -304,23 +311,41 @@ class ProgressReport(object):
         if simulation.topology.getUnitCellDimensions() != None :
             self._units['density'] = kilogram / meter**3
             self._units['volume'] = nanometer**3
-        self._data = defaultdict(list)
         self._total = total
         # The time step at the creation of this report.
         self._first = first
         self.run_time = 0.0*picosecond
-        self.rt00 = 0.0*picosecond
+        self.rt00 = 0.0 # ps
         self.t0 = time.time()
+        self.t00 = None
         self.args = args
 
+        # Total mass and degrees of freedom are fixed for the run: one pass over the particles here
+        # instead of a compute_mass loop in every report
+        mass = 0.0
         ndof = 0
         for ii in range(simulation.system.getNumParticles()): #Added 2019.02.06. From StateDataReporeter, Python
-            if simulation.system.getParticleMass(ii) > 0*unit.dalton: #Careful to make sure virtual sites are not included in calculation. loop is slow but only calculated once
+            m = simulation.system.getParticleMass(ii).value_in_unit(amu)
+            mass += m
+            if m > 0: #Careful to make sure virtual sites are not included in calculation.
                 ndof += 3
         ndof -= simulation.system.getNumConstraints()
         if any(type(simulation.system.getForce(ii)) == CMMotionRemover for ii in range(simulation.system.getNumForces())):
             ndof -= 3
         self.ndof = ndof
+        # Total mass in grams.
+        self.mass = (mass*amu).in_units_of(gram / mole) / AVOGADRO_CONSTANT_NA
+
+        # Unit conversions hoisted out of report(): quantities are read as plain floats in the reporting units
+        kB = BOLTZMANN_CONSTANT_kB * AVOGADRO_CONSTANT_NA
+        self._temperatureFactor = 2.0 * self._units['kinetic'] / kB / self.ndof / self._units['temperature']
+        self._timestep = (args.timestep * femtosecond) / picosecond
+        if 'density' in self._units:
+            self._densityFactor = self.mass / self._units['volume'] / self._units['density']
+
+        # Time series of the reported quantities, preallocated for the expected number of reports and grown by doubling
+        self._ndata = 0
+        self._data = OrderedDict([(datatype, np.zeros(int(total // reportInterval) + 2)) for datatype in self._units])
 
     def describeNextReport(self, simulation):
         steps = self._reportInterval - simulation.currentStep%self._reportInterval
@@ -329,7 +354,7 @@ class ProgressReport(object):
     def analyze(self, simulation):
         PrintDict = OrderedDict()
         for datatype in self._units:
-            data   = np.array(self._data[datatype])
+            data   = self._data[datatype][:self._ndata]
             mean   = np.mean(data)
             dmean  = data - mean
             stdev  = np.std(dmean)
@@ -348,21 +373,26 @@ class ProgressReport(object):
         printcool_dictionary(PrintDict,"Summary statistics - total simulation time %.3f ps:\n%-26s %13s %13s %13s %13s %13s %13s\n%-26s %13s %13s %13s %13s %13s %13s" % (self.run_time/picosecond,
                                                                                                                                                                           "", "", "", "", "", "", "Stdev",
                                                                                                                                                                           "Quantity", "Mean", "Stdev", "Stderr", "Acorr(ps)", "Drift", "(NoDrift)"),keywidth=30)
+    def append(self, **values):
+        # Store one report in the time series buffers, doubling them when full
+        if self._ndata == self._data['energy'].size:
+            for datatype in self._data:
+                self._data[datatype] = np.concatenate([self._data[datatype], np.zeros(self._data[datatype].size)])
+        for datatype in values:
+            self._data[datatype][self._ndata] = values[datatype]
+        self._ndata += 1
+
     def report(self, simulation, state):
-        # Compute total mass in grams.
-        mass = compute_mass(simulation.system).in_units_of(gram / mole) /  AVOGADRO_CONSTANT_NA
         # The center-of-mass motion remover subtracts 3 more DoFs
         #ndof = 3*simulation.system.getNumParticles() - simulation.system.getNumConstraints() - 3
 
-
-        kinetic = state.getKineticEnergy()
-        potential = state.getPotentialEnergy() / self._units['potential']
-        kB = BOLTZMANN_CONSTANT_kB * AVOGADRO_CONSTANT_NA
-        temperature = 2.0 * kinetic / kB / self.ndof / self._units['temperature'] #somehow reports wrong... dof prob calculated wrong. use code from stateDataReporter on github instead
-        kinetic /= self._units['kinetic']
+        kinetic = state.getKineticEnergy().value_in_unit(self._units['kinetic'])
+        potential = state.getPotentialEnergy().value_in_unit(self._units['potential'])
+        temperature = kinetic * self._temperatureFactor #somehow reports wrong... dof prob calculated wrong. use code from stateDataReporter on github instead
         energy = kinetic + potential
         pct = 100 * float(simulation.currentStep - self._first) / self._total
-        self.run_time = float(simulation.currentStep - self._first) * self.args.timestep * femtosecond
+        run_time = float(simulation.currentStep - self._first) * self._timestep
+        self.run_time = run_time * picosecond
         if pct != 0.0:
             timeleft = (time.time()-self.t0)*(100.0 - pct)/pct
         else:
@@ -373,27 +403,22 @@ class ProgressReport(object):
             nsday = 0.0
         else:
             days = (time.time()-self.t00)/86400
-            nsday = (self.run_time - self.rt00) / nanoseconds / days
+            nsday = (run_time - self.rt00) / 1000.0 / days
         self.t00 = time.time()
-        self.rt00 = self.run_time
+        self.rt00 = run_time
 
         if simulation.topology.getUnitCellDimensions() != None :
-            box_vectors = state.getPeriodicBoxVectors()
-            volume = compute_volume(box_vectors) / self._units['volume']
-            density = (mass / compute_volume(box_vectors)) / self._units['density']
+            volume = np.linalg.det(state.getPeriodicBoxVectors(asNumpy=True).value_in_unit(nanometer))
+            density = self._densityFactor / volume
             if self._initial:
                 logger.info("%8s %17s %15s %13s %13s %13s %13s %13s %13s %13s" % ('Progress', 'E.T.A', 'Speed (ns/day)', 'Time(ps)', 'Temp(K)', 'Kin(kJ)', 'Pot(kJ)', 'Ene(kJ)', 'Vol(nm3)', 'Rho(kg/m3)'))
-            logger.info("%7.3f%% %17s %15.5f %13.5f %13.5f %13.5f %13.5f %13.5f %13.5f %13.5f" % (pct, GetTime(timeleft), nsday, self.run_time / picoseconds, temperature, kinetic, potential, energy, volume, density))
-            self._data['volume'].append(volume)
-            self._data['density'].append(density)
+            logger.info("%7.3f%% %17s %15.5f %13.5f %13.5f %13.5f %13.5f %13.5f %13.5f %13.5f" % (pct, GetTime(timeleft), nsday, run_time, temperature, kinetic, potential, energy, volume, density))
+            self.append(energy=energy, kinetic=kinetic, potential=potential, temperature=temperature, volume=volume, density=density)
         else:
             if self._initial:
                 logger.info("%8s %17s %13s %13s %13s %13s %13s" % ('Progress', 'E.T.A', 'Time(ps)', 'Temp(K)', 'Kin(kJ)', 'Pot(kJ)', 'Ene(kJ)'))
-            logger.info("%7.3f%% %17s %13.5f %13.5f %13.5f %13.5f %13.5f" % (pct, GetTime(timeleft), self.run_time / picoseconds, temperature, kinetic, potential, energy))
-        self._data['energy'].append(energy)
-        self._data['kinetic'].append(kinetic)
-        self._data['potential'].append(potential)
-        self._data['temperature'].append(temperature)
+            logger.info("%7.3f%% %17s %13.5f %13.5f %13.5f %13.5f %13.5f" % (pct, GetTime(timeleft), run_time, temperature, kinetic, potential, energy))
+            self.append(energy=energy, kinetic=kinetic, potential=potential, temperature=temperature)
         self._initial = False
 
     def __del__(self):
@@ -6,13 +6,14 @@
 #
 # New version: 12/08/15 - added automated warmup detection based on MSER-5 (Euro. J. Op. Res. 173, 252 (2006))
 # New version: 15/08/16 - added ability to process multiple data columns in one command-line invokation
+# New version: 17/10/26 - added batch processing of multiple files (glob patterns) in a process pool
 
 
-# TODO:
-# Allow multiple files to be processed at once(?)
 import numpy as np
 import scipy.stats as stat
+import os
 import sys
+import datacache
 
 def decideColumn(filehandler,observablename):
     # Be sure we're at the beginning of the file
@@ -44,17 +45,75 @@ def decideColumn(filehandler,observablename):
         sys.stderr.write("\nError: instruction to detect column from observable name. No valid header in file.\n")
         sys.exit(1)
 
-def extractData(filehandler,column,warmup,delimiter=None):
+def parseLines(text,columns,delimiter=None):
+    # Parse a block of complete lines into an [nrows,len(columns)] array (None if there is no data)
+    # Comment lines are skipped. Whitespace-delimited data is parsed by a single np.fromstring call;
+    # other delimiters, and blocks that are not a regular table (any line with another field count), go through np.loadtxt
+    if '#' in text:
+        text=''.join([l for l in text.splitlines(True) if not l.lstrip().startswith('#')])
+    if not text.strip():
+        return None
+    if delimiter is None:
+        if not text.endswith('\n'):
+            text=text+'\n'
+        lines=text.splitlines()
+        ncols=len(lines[0].split())
+        # Every line must hold ncols fields, or a ragged block could still fill a whole [nrows,ncols] array
+        if all(len(l.split()) == ncols for l in lines):
+            values=np.fromstring(text,sep=' ')
+            if values.size == len(lines)*ncols:
+                values=values.reshape(-1,ncols)
+                return values if columns is None else values[:,columns]
+    return np.loadtxt(text.splitlines(),delimiter=delimiter,usecols=columns,ndmin=2)
+
+
+def loadColumns(filehandler,columns,delimiter=None,chunksize=2**26):
+    # Parse the file once, keeping only the requested columns: returns an [nrows,len(columns)] array
+    # The file is read in large chunks of whole lines, each parsed by parseLines
+    # columns=None keeps every column
     # Be sure we're at the beginning of the file
     filehandler.seek(0)
-    # Read the file - First get all of the data
-    AllData=np.loadtxt(filehandler, delimiter=delimiter)
-    # Copy to a 1D Numpy array for faster analysis
-    Data1=AllData[:,column]
+    if columns is not None:
+        columns=list(columns)
+    if delimiter is not None:
+        return np.loadtxt(filehandler,delimiter=delimiter,usecols=columns,ndmin=2)
+    blocks=[]
+    tail=''
+    while True:
+        chunk=filehandler.read(chunksize)
+        text=tail+chunk
+        if chunk:
+            # Keep the incomplete last line for the next chunk
+            cut=text.rfind('\n')+1
+            text,tail=text[:cut],text[cut:]
+        values=parseLines(text,columns)
+        if values is not None:
+            blocks.append(values)
+        if not chunk:
+            break
+    if len(blocks) == 0:
+        return np.empty([0,0 if columns is None else len(columns)])
+    return np.concatenate(blocks)
+
+
+def loadCachedColumns(filename,columns,delimiter=None,cache=True):
+    # loadColumns through the binary sidecar cache: the full table is parsed once per version of the file
+    # to write the cache; without a cache only the requested columns are parsed
+    parser=lambda f,delimiter,skiprows,usecols: loadColumns(f,usecols,delimiter)
+    return datacache.loadTable(filename,columns,delimiter,parser=parser,cache=cache)[0]
+
+
+def extractData(filehandler,column,warmup,delimiter=None):
+    # Read the requested column - Copy to a 1D Numpy array for faster analysis
+    Data1=loadColumns(filehandler,[column],delimiter)[:,0]
+    return splitWarmup(Data1,warmup)
+
+
+def splitWarmup(Data1,warmup):
     # Check for NaN in the data
     if np.isnan(np.min(Data1)): # Note: min() propagates NaN. Checking result of reduction operator faster than creating a vector of results.
         sys.stderr.write("WARNING: NaN in data. Run diverged. Proceeding with bad samples removed.\n")
-        Data1=Data1[numpy.isfinite(Data)]
+        Data1=Data1[np.isfinite(Data1)]
     # Check data size > warmup
     if Data1.size < warmup:
         sys.stderr.write("WARNING: Warmup length is greater than sample size. Reducing to warmup=0\n")
@@ -66,35 +125,91 @@ def extractData(filehandler,column,warmup,delimiter=None):
         return np.empty([0]),Data1
 
 
-def doStats(warmupdata,Data,doGraphs=False,doWriteStdout=False,graphFilenameStub=''):
+def autocorrelation(Data_dcshift,nlags):
+    # Sums of x[i]*x[i+j] for lags j=0..nlags-1, from one zero-padded FFT: O(N log N) instead of the O(N^2) of np.correlate
+    # Padding to >= 2N-1 points avoids the wrap-around of the circular correlation
+    N=Data_dcshift.size
+    nfft=int(2**np.ceil(np.log2(max(2*N-1,1))))
+    f=np.fft.rfft(Data_dcshift,nfft)
+    return np.fft.irfft(f*np.conj(f),nfft)[:nlags]
+
+
+def blockingTransform(Data):
+    # Flyvbjerg-Petersen blocking (J. Chem. Phys. 91, 461 (1989)) of Data ([N] or [N,ncol]) along axis 0:
+    # level l holds the N//2^l means of consecutive blocks of 2^l samples, and each level is one reshape-and-mean
+    # of the previous one, so the log2(N) levels cost O(N) in total.
+    # Returns the number of blocks [nlevels] and the naive standard error of their mean [nlevels,...] at each level with >= 2 blocks
+    values=np.asarray(Data,dtype=float)
+    nblocks=[]
+    sems=[]
+    while values.shape[0] > 1:
+        n=values.shape[0]
+        nblocks.append(n)
+        sems.append(np.std(values,axis=0,ddof=1)/np.sqrt(n))
+        values=np.mean(values[:2*(n//2)].reshape((n//2,2)+values.shape[1:]),axis=1)
+    return np.array(nblocks),np.array(sems)
+
+
+def blockingPlateau(nblocks,sems):
+    # Choose the Flyvbjerg-Petersen blocking level for each column: the smallest level l, of block size B=2^l, with
+    # B^3 > 2 N (SEM_l/SEM_0)^4 (Lee et al., Phys. Rev. E 83, 066706 (2011)).
+    # nblocks [nlevels] and sems [nlevels,ncols] come from levels with at least 2 blocks.
+    # The criterion assumes a plateau exists, so the next level must also agree within twice the error bar
+    # SEM_l/sqrt(2(n_l-1)) of the chosen one.
+    # Returns the chosen level and whether it is converged; if the criterion is never met, the last level is used.
+    blocksize=2.**np.arange(nblocks.size)
+    ratio=sems/np.where(sems[0] > 0,sems[0],1.)
+    ok=(blocksize**3)[:,None] > 2.*nblocks[0]*ratio**4
+    converged=np.any(ok,axis=0)
+    level=np.where(converged,np.argmax(ok,axis=0),nblocks.size-1)
+    cols=np.arange(sems.shape[1])
+    nextlevel=np.minimum(level+1,nblocks.size-1)
+    errbar=sems[level,cols]/np.sqrt(2.*(nblocks[level]-1))
+    converged&=np.abs(sems[nextlevel,cols]-sems[level,cols]) <= 2.*errbar
+    return level,converged
+
+
+def doStats(warmupdata,Data,doGraphs=False,doWriteStdout=False,graphFilenameStub='',method='kappa'):
+    # method='kappa' corrects the standard error with the integrated autocorrelation time;
+    # method='blocking' takes it from the blocking-transform plateau instead, and reports the equivalent kappa.
+    # The autocorrelation function is then only computed for graphs (None is returned otherwise)
     # Mean, min, max, variance
     (nsamples,(min,max),mean,unbiasedvar,skew,kurtosis)=stat.describe(Data) # Unbiasedvar is actually the reduced-bias estimator of population variance (~1/(N-1)...)
     # Standard error of mean:
     sem=stat.sem(Data) # Not yet correlation corrected
 
-    # Compute the autocorrelation function:
-    Data_dcshift=Data-mean
-    #DataNorm=np.sum(np.square(Data_dcshift))
-    cor=np.correlate(Data_dcshift,Data_dcshift,mode='same')/unbiasedvar
-    autocor=cor[cor.size/2:]
-    autocor=autocor/np.arange(nsamples-1,nsamples-1-autocor.size,-1) # Note -1 for 0-based indexing
-
-    # Choose where to cutoff the autocorrelation time sum
-    cutoff=autocor.size
-    j=0
-    while j<cutoff:
-        if autocor[j] < np.sqrt(2./(nsamples-j)):
-            cutoff = np.minimum(cutoff,5*j)
-        j=j+1
-    # Compute correlation time
-    kappa=1.+2.*np.sum(autocor[1:int(2.*cutoff/5.)])
-    # We can also make an array of all possible cutoffs
-    if doGraphs:
-      kappa_cutoffdep=np.ones(autocor.size)
-      for jc in range(1,autocor.size):
-        kappa_cutoffdep[jc]=1+2*np.sum(autocor[1:jc])
-    # Update the standard error of the mean for a correlation correction
-    semcc=sem*np.sqrt(kappa)
+    autocor=None
+    if method == 'kappa' or doGraphs:
+      # Compute the autocorrelation function:
+      Data_dcshift=Data-mean
+      #DataNorm=np.sum(np.square(Data_dcshift))
+      # Same lags as the second half of np.correlate(Data_dcshift,Data_dcshift,mode='same')
+      cor=autocorrelation(Data_dcshift,nsamples-nsamples//2)/unbiasedvar
+      autocor=cor/np.arange(nsamples-1,nsamples-1-cor.size,-1) # Note -1 for 0-based indexing
+
+      # Choose where to cutoff the autocorrelation time sum: 5x the first lag j where autocor[j] < sqrt(2/(nsamples-j))
+      cutoff=autocor.size
+      j=np.flatnonzero(autocor < np.sqrt(2./(nsamples-np.arange(autocor.size))))
+      if j.size > 0:
+          cutoff = np.minimum(cutoff,5*j[0])
+      # Compute correlation time
+      kappa=1.+2.*np.sum(autocor[1:int(2.*cutoff/5.)])
+      # We can also make an array of all possible cutoffs: kappa_cutoffdep[jc] = 1+2*sum(autocor[1:jc])
+      if doGraphs:
+        kappa_cutoffdep=np.ones(autocor.size)
+        kappa_cutoffdep[2:]=1+2*np.cumsum(autocor[1:-1])
+
+    if method == 'blocking':
+      nblocks,sems=blockingTransform(Data)
+      level,converged=blockingPlateau(nblocks,sems.reshape(nblocks.size,1))
+      level,converged=level[0],converged[0]
+      semcc=sems[level]
+      kappa=np.square(semcc/sem)
+      if not converged:
+        sys.stderr.write("WARNING: No plateau in the blocking transform. Error estimate is unreliable; more samples are needed.\n")
+    else:
+      # Update the standard error of the mean for a correlation correction
+      semcc=sem*np.sqrt(kappa)
 
     # Manual (non-Numpy) autocorrelation function for transparency - verified equal
     #j=0
@@ -113,6 +228,8 @@ def doStats(warmupdata,Data,doGraphs=False,doWriteStdout=False,graphFilenameStub
         print "  - Mean                    = ",mean," +/- ",semcc
         print "  - Equilibrated samples    = ",nsamples
         print "  - Correlation time        = ",kappa
+        if method == 'blocking':
+          print "  - Blocking block size     = ",2**level,"(",nblocks[level],"blocks)"
         print "  - Effective # samples     = ",nsamples/kappa
         print "  - Reduced-bias variance   = ",unbiasedvar
         # note that there is no unbiased estimator for the population standard deviation. We can use sqrt(var) as a indicative estimator.
@@ -162,8 +279,14 @@ def doStats(warmupdata,Data,doGraphs=False,doWriteStdout=False,graphFilenameStub
         #pl.xlim(0,plotxmax)
         #
         pl.subplot(224)
-        pl.plot(kappa_cutoffdep)
-        pl.title("Correlation time estimator vs. cutoff")
+        if method == 'blocking':
+          pl.errorbar(np.arange(nblocks.size),sems,yerr=sems/np.sqrt(2.*(nblocks-1)))
+          pl.axvline(level,color='red')
+          pl.title("Blocking transform")
+          pl.xlabel('$\\log_2$ block size')
+        else:
+          pl.plot(kappa_cutoffdep)
+          pl.title("Correlation time estimator vs. cutoff")
         #pl.xlabel('$\\tau_{cut}$')
         #pl.ylabel('$\\Kappa$')
         #pl.axhline(0,color='black')
@@ -173,56 +296,49 @@ def doStats(warmupdata,Data,doGraphs=False,doWriteStdout=False,graphFilenameStub
     return (nsamples,(min,max),mean,semcc,kappa,unbiasedvar,autocor)
 
 
-def autoWarmupMSER(filehandler, col, debug=False, delimiter=None):
+def warmupMSER(data, m=5, debug=False):
+    # MSER-m warmup detection for each column of data ([N] or [N,ncol]), returning the warmup length in samples
     # Algorithm:
-    # - Load all data
-    # - Compute SEM with d samples truncated from beginning. The samples are supposed to be batch-averaged. This will be the case in most simulation data anyway.
+    # - Compute SEM with d blocks of m samples truncated from beginning. The samples are supposed to be batch-averaged. This will be the case in most simulation data anyway.
     # - Find the value of d that minimizes SEM. This is the warmup length.
-    filehandler.seek(0)
-    dummy, data = extractData(filehandler, col, 0, delimiter=delimiter)
-
-    # MSER-5 - pre-block-average the data in chunks of 5 steps, and truncate integer counts of those steps
-    m = 5 # Block size
-    N = len(data)
+    # The SEM of every truncation is obtained at once from reverse cumulative sums and sums of squares,
+    # so the cost is O(N) for any number of columns
+    N = data.shape[0]
     # Data will be padded in such a way that block average is not modified.
     # We are short by m-N%m points to make N/m an integer.
     # Then do the block averaging
     if N%m != 0:
-        #dataint = np.pad(data, (0,m-N%m), mode='mean', stat_length=N%m)
-        #databa = np.mean(dataint.reshape(int(N/m), m), axis=1)
-        databa = np.mean(np.pad(data, (0,m-N%m), mode='mean', stat_length=N%m).reshape(int(N/m)+1, m), axis=1)
-        N = N + m - N%m
-    else:
-        databa = np.mean(data.reshape(int(N/m), m), axis=1)
+        padding = [(0,m-N%m)] + [(0,0)]*(data.ndim-1)
+        data = np.pad(data, padding, mode='mean', stat_length=N%m)
+    databa = np.mean(data.reshape((data.shape[0]//m, m) + data.shape[1:]), axis=1)
 
-    if debug:
-        fileout = open("debugMSER.dat","w")
-    SEMlist=[]
-    fullsize = len(databa)
-    while True:
-      # It is slow to do a full correlation-corrected statistical analysis in the inner loop
-      # Rather than computing everything, just use correlation biased SEM
-#      (n,(min,max),mean,semcc,kappa,unbiasedvar,autocor)=doStats(dummy,databa,False,False)
-      sem = stat.sem(databa)
-#      var = unbiasedvar * (n-1)/n # The MSER method uses the biased sample variance as a measure of homogeneity of the data
-#      VARlist.append(var)
-#      SEMlist.append(semcc)
-      SEMlist.append(sem)
-      if debug:
-          fileout.write("{0} {1}\n".format(len(databa),semcc))
-      # Ensure we don't go below 25% of data remaining or 5 samples or that we don't iterate more than 1000 times.
-      Nrem = len(databa)
-      if Nrem <= 0.25*fullsize or Nrem < 5:
-          break
-      # TO DO: replace with masked array to avoid repeated copy
-      databa = databa[1:] # Delete the first m elements
+    # Truncations d = 0, 1, ... until we would go below 25% of data remaining or 5 samples
+    fullsize = databa.shape[0]
+    nrem = fullsize - np.arange(fullsize)
+    ntrunc = np.flatnonzero((nrem <= 0.25*fullsize) | (nrem < 5))[0] + 1
+    nrem = nrem[:ntrunc].reshape((ntrunc,) + (1,)*(data.ndim-1))
+    # It is slow to do a full correlation-corrected statistical analysis for every truncation
+    # Rather than computing everything, just use correlation biased SEM
+    # Shift by the mean first, so that the sums of squares do not lose precision to the offset
+    shifted = databa - np.mean(databa, axis=0)
+    S1 = np.cumsum(shifted[::-1], axis=0)[::-1][:ntrunc]
+    S2 = np.cumsum(np.square(shifted[::-1]), axis=0)[::-1][:ntrunc]
+    SEMlist = np.sqrt((S2 - np.square(S1)/nrem)/(nrem-1)/nrem)
 
     if debug:
-        fileout.close()
+        np.savetxt("debugMSER.dat", np.column_stack([nrem[:,0] if data.ndim > 1 else nrem, SEMlist]))
 
     # Find the index that minimizes the variance
-    idx = np.argmin(SEMlist) # idx is therefore the number of warmup blocks to be removed; m*idx is # samples
-    idx = idx*m
+    idx = np.argmin(SEMlist, axis=0) # idx is therefore the number of warmup blocks to be removed; m*idx is # samples
+    return idx*m
+
+
+def autoWarmupMSER(filehandler, col, debug=False, delimiter=None):
+    # Load the column and split it at the MSER-5 warmup length (see warmupMSER)
+    filehandler.seek(0)
+    dummy, data = extractData(filehandler, col, 0, delimiter=delimiter)
+
+    idx = int(warmupMSER(data, 5, debug))
 
     if idx > 0:
         warmupdata = data[:idx-1]
@@ -233,18 +349,285 @@ def autoWarmupMSER(filehandler, col, debug=False, delimiter=None):
     return warmupdata, proddata, idx
 
 
+def mergeMoments(n,mean,m2,values):
+    # Chan et al. pairwise update of count, mean and sum of squared deviations with a batch of rows
+    nb=values.shape[0]
+    meanb=np.mean(values,axis=0)
+    m2b=np.sum(np.square(values-meanb),axis=0)
+    ntot=n+nb
+    delta=meanb-mean
+    return ntot,mean+delta*nb/ntot,m2+m2b+np.square(delta)*n*nb/ntot
+
+
+class OnlineStats:
+    # Running statistics of a growing [nrows,ncols] series, each update costing O(new rows) with bounded memory:
+    # - Flyvbjerg-Petersen blocking: count, mean and sum of squared deviations of the block means at each
+    #   level l (block size 2^l), with at most one unpaired block mean carried per level.
+    #   Level 0 is the Welford mean and variance of the data itself.
+    # - Lag sums x[t]*x[t+j] for j < nlags, from the new rows and the last nlags rows kept in memory,
+    #   with the first nlags rows kept for the mean correction. Up to nlags, the autocorrelation function
+    #   and correlation time are the same as those of doStats on the whole series.
+    # All sums are of x - (first row), so that a large offset does not cost precision
+    def __init__(self,ncols,nlags=2048):
+        self.ncols=ncols
+        self.nlags=nlags
+        self.shift=None
+        self.levels=[]   # [count, mean, m2] per blocking level
+        self.pending=[]  # unpaired block mean per level, or None
+        self.total=np.zeros(ncols)
+        self.lagsums=np.zeros([nlags,ncols])
+        self.head=np.empty([0,ncols])
+        self.tail=np.empty([0,ncols])
+
+    @property
+    def n(self):
+        return self.levels[0][0] if self.levels else 0
+
+    def update(self,rows):
+        rows=np.asarray(rows,dtype=float).reshape(-1,self.ncols)
+        if rows.shape[0] == 0:
+            return
+        if self.shift is None:
+            self.shift=rows[0].copy()
+        y=rows-self.shift
+        # Blocking levels, carrying pairs of block means up one level at a time
+        level=0
+        values=y
+        while values.shape[0] > 0:
+            if level == len(self.levels):
+                self.levels.append([0,np.zeros(self.ncols),np.zeros(self.ncols)])
+                self.pending.append(None)
+            self.levels[level]=list(mergeMoments(*(self.levels[level]+[values])))
+            if self.pending[level] is not None:
+                values=np.concatenate([self.pending[level],values])
+            npair=values.shape[0]//2
+            self.pending[level]=values[-1:].copy() if values.shape[0]%2 else None
+            values=0.5*(values[0:2*npair:2]+values[1:2*npair:2])
+            level+=1
+        # Lag sums: r[k] = sum_i y[i]*w[i+k] over w = (kept tail, new rows), from one zero-padded FFT.
+        # The new products of lag j are r[H-j]; padding to >= nb+nlags points keeps negative k from wrapping onto data
+        H=self.tail.shape[0]
+        w=np.concatenate([self.tail,y])
+        nfft=int(2**np.ceil(np.log2(y.shape[0]+self.nlags)))
+        r=np.fft.irfft(np.conj(np.fft.rfft(y,nfft,axis=0))*np.fft.rfft(w,nfft,axis=0),nfft,axis=0)
+        self.lagsums+=r[(H-np.arange(self.nlags))%nfft]
+        self.total+=np.sum(y,axis=0)
+        if self.head.shape[0] < self.nlags:
+            self.head=np.concatenate([self.head,y[:self.nlags-self.head.shape[0]]])
+        self.tail=w[-self.nlags:].copy()
+
+    def mean(self):
+        return self.levels[0][1]+self.shift
+
+    def variance(self):
+        # Reduced-bias variance, as from scipy.stats.describe
+        return self.levels[0][2]/(self.n-1)
+
+    def autocorrelation(self):
+        # Normalised as in doStats, over lags j < min(nlags, N-N//2)
+        N=self.n
+        nl=min(self.nlags,N-N//2)
+        j=np.arange(nl)
+        m=self.levels[0][1]
+        zero=np.zeros([1,self.ncols])
+        firstsums=np.concatenate([zero,np.cumsum(self.head[:nl-1],axis=0)])        # sum of y[t], t < j
+        lastsums=np.concatenate([zero,np.cumsum(self.tail[::-1][:nl-1],axis=0)])   # sum of y[t], t >= N-j
+        S=self.lagsums[:nl]-m*(2*self.total-firstsums-lastsums)+(N-j)[:,None]*np.square(m)
+        return S/(self.variance()*(N-1-j)[:,None])
+
+    def kappa(self):
+        # Correlation time with the doStats cutoff rule. windowed is True for the columns whose
+        # cutoff was not found within the nlags kept: their sum is truncated at the window
+        N=self.n
+        autocor=self.autocorrelation()
+        nl=autocor.shape[0]
+        size=N-N//2
+        below=autocor < np.sqrt(2./(N-np.arange(nl)))[:,None]
+        found=np.any(below,axis=0)
+        cutoff=np.where(found,np.minimum(size,5*np.argmax(below,axis=0)),size)
+        nsum=(2*cutoff)//5
+        windowed=(nsum > nl) | (~found & (nl < size))
+        csum=np.concatenate([np.zeros([2,self.ncols]),np.cumsum(autocor[1:],axis=0)])  # csum[c] = sum(autocor[1:c])
+        kappa=1.+2.*csum[np.minimum(nsum,nl),np.arange(self.ncols)]
+        return kappa,windowed
+
+    def blocking(self):
+        # Standard error of the mean at each blocking level with at least 2 blocks, and the plateau estimate
+        nblocks=np.array([lev[0] for lev in self.levels if lev[0] > 1])
+        sems=np.array([np.sqrt(lev[2]/(lev[0]*(lev[0]-1.))) for lev in self.levels if lev[0] > 1])
+        level,converged=blockingPlateau(nblocks,sems)
+        return sems[level,np.arange(self.ncols)],level,converged
+
+
+def followFile(filehandler,columns,labels,warmup=0,delimiter=None,interval=10.,nlags=2048,quiet=False):
+    # Tail a growing data file, updating OnlineStats with the rows appended since the last poll,
+    # and print the correlation-corrected errors after each update. Runs until interrupted.
+    # If the file shrinks (restarted run), the statistics start over.
+    import time
+    columns=list(columns)
+    filehandler.seek(0)
+    position=0
+    tail=''
+    skip=warmup
+    online=OnlineStats(len(columns),nlags)
+    nanwarned=False
+    try:
+        while True:
+            if os.fstat(filehandler.fileno()).st_size < position:
+                sys.stderr.write("WARNING: File was truncated. Restarting statistics.\n")
+                filehandler.seek(0)
+                tail=''
+                skip=warmup
+                online=OnlineStats(len(columns),nlags)
+            text=tail+filehandler.read()
+            position=filehandler.tell()
+            cut=text.rfind('\n')+1
+            text,tail=text[:cut],text[cut:]
+            rows=parseLines(text,columns,delimiter) if cut > 0 else None
+            if rows is not None and skip > 0:
+                nskip=min(skip,rows.shape[0])
+                rows=rows[nskip:]
+                skip-=nskip
+            if rows is not None and rows.shape[0] > 0:
+                good=np.all(np.isfinite(rows),axis=1)
+                if not np.all(good):
+                    if not nanwarned:
+                        sys.stderr.write("WARNING: NaN in data. Run diverged. Proceeding with bad samples removed.\n")
+                        nanwarned=True
+                    rows=rows[good]
+                online.update(rows)
+                if online.n > 3:
+                    printOnline(online,labels,quiet)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return online
+
+
+def printOnline(online,labels,quiet=False):
+    mean=online.mean()
+    kappa,windowed=online.kappa()
+    semcc=np.sqrt(online.variance()/online.n*kappa)
+    semblock,level,converged=online.blocking()
+    if quiet:
+        sys.stdout.write("{0} ".format(online.n))
+        for k in range(len(labels)):
+            sys.stdout.write("{0} {1} ".format(mean[k],semcc[k]))
+        sys.stdout.write("\n")
+    else:
+        print "Samples {0}".format(online.n)
+        for k in range(len(labels)):
+            print "  - {0}: {1} +/- {2} (kappa = {3}{4}), blocking +/- {5} (block size {6}{7})".format(
+                labels[k],mean[k],semcc[k],kappa[k],", window too short" if windowed[k] else "",
+                semblock[k],2**level[k],"" if converged[k] else ", no plateau")
+    sys.stdout.flush()
+
+
+def decideColumns(filehandler,col=None,observable=None):
+    # Column indices and labels for a list of column indices or of header observable names
+    if col != None:
+        return list(col),['col{0}'.format(i) for i in col]
+    return [decideColumn(filehandler,i) for i in observable],list(observable)
+
+
+def analyzeFile(filename,col=None,observable=None,autowarmup=False,warmup=100,method='kappa',delimiter=None,graphs=False,verbose=False,cache=True):
+    # Statistics of the requested columns of one data file (see doStats).
+    # Returns one (label,mean,semcc,kappa,warmup,nsamples) tuple per column
+    with open(filename,'r') as f:
+        columns,labels=decideColumns(f,col,observable)
+    # Parse the file once (or load its cached table), keeping only the requested columns; all observables are analysed from this array
+    # (the full table is only parsed to write the cache)
+    AllData = loadCachedColumns(filename, columns, delimiter, cache)
+    if autowarmup and np.all(np.isfinite(AllData)):
+        # MSER-5 for all columns at once
+        nwarmups = warmupMSER(AllData)
+
+    # Loop through column records or observable names and do stats
+    results=[]
+    for k in range(len(columns)):
+        if verbose:
+            if col != None:
+                print "Processing column index {0}".format(col[k])
+            else:
+                print "Processing observable {0}".format(observable[k])
+        Data1 = AllData[:,k]
+        if autowarmup:
+            if not np.all(np.isfinite(AllData)):
+                # Bad samples are removed first, so this column needs its own warmup detection
+                dummy, Data1 = splitWarmup(Data1, 0)
+                nwarmup = warmupMSER(Data1)
+            else:
+                nwarmup = nwarmups[k]
+            if verbose:
+                print "Auto warmup detection with MSER-5 => ",nwarmup
+        else:
+            nwarmup = warmup
+        warmupdata,Data = splitWarmup(Data1, nwarmup)
+        if np.count_nonzero(np.isfinite(Data1)) < nwarmup:
+            nwarmup = 0 # as splitWarmup did
+        # Do the statistics
+        (nsamples,minmax,mean,semcc,kappa,unbiasedvar,autocor)=doStats(warmupdata,Data,graphs,verbose,'_{0}_{1}'.format(filename,labels[k]),method)
+        results.append((labels[k],mean,semcc,kappa,int(nwarmup),nsamples))
+    return results
+
+
+def batchWorker(task):
+    # Process-pool worker for batch mode: analyse one file quietly.
+    # A file that fails (the column helpers sys.exit on bad input) is reported and returns None
+    filename,options=task
+    try:
+        return filename,analyzeFile(filename,**options)
+    except SystemExit:
+        sys.stderr.write("Error: {0} skipped\n".format(filename))
+        return filename,None
+    except Exception as e:
+        sys.stderr.write("Error: {0}: {1}\n".format(filename,e))
+        return filename,None
+
+
+def expandFiles(patterns):
+    # Expand glob patterns, each sorted, in the order given; repeated files are kept once
+    import glob
+    files=[]
+    for pattern in patterns:
+        matches=sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            sys.stderr.write("\nError: No file matches {0}\n".format(pattern))
+            sys.exit(1)
+        files.extend([f for f in matches if f not in files])
+    return files
+
+
+def writeSummary(out,results):
+    # One whitespace-delimited row per file and column
+    out.write("# file column mean error kappa warmup nsamples\n")
+    for filename,rows in results:
+        if rows is None:
+            continue
+        for (label,mean,semcc,kappa,nwarmup,nsamples) in rows:
+            out.write("{0} {1} {2!r} {3!r} {4!r} {5} {6}\n".format(filename,label,float(mean),float(semcc),float(kappa),nwarmup,nsamples))
+    out.flush()
+
+
 if __name__ == "__main__":
   # For command-line runs, build the relevant parser
   import argparse as ap
   parser = ap.ArgumentParser(description='Statistical analysis of PolyFTS data')
-  parser.add_argument('-f','--file',default='./operators.dat',type=ap.FileType('r'),help='Filename containing scalar statistical data.')
+  parser.add_argument('-f','--file',default=['./operators.dat'],nargs='+',help='Filename(s) or glob pattern(s) of files containing scalar statistical data. Several files are analysed in parallel into one summary table.')
   parser.add_argument('-c', '--col',nargs='+',type=int,help='Column to use for statistical analysis.')
   parser.add_argument('-o', '--observable',nargs='+',type=str,help='Observable name for statistical analysis.')
   parser.add_argument('-g','--graphs',default=False,dest='graphs',action='store_true',help='Enable output of graphs showing statistical analysis.')
   parser.add_argument('-a','--autowarmup',default=False,dest='autowarmup',action='store_true',help='Use MSER-5 method to automate warmup detection')
   parser.add_argument('-w', '--warmup',default=100,type=int,help='Number of samples to eliminate from the beginning of the data.')
+  parser.add_argument('-m','--method',default='kappa',choices=['kappa','blocking'],help='Error estimator: integrated autocorrelation time (kappa) or Flyvbjerg-Petersen blocking')
   parser.add_argument('-q','--quiet',default=False,dest='quiet',action='store_true',help='Write minimal information to stdout')
   parser.add_argument('-d','--delimiter',default=None,dest='delimiter',help='delimiter, default is None (uses numpy default, whitespace)')
+  parser.add_argument('--follow',default=False,dest='follow',action='store_true',help='Follow a growing file, printing updated statistics as rows are appended (stop with Ctrl-C)')
+  parser.add_argument('--interval',default=10.,type=float,help='Seconds between polls of the file in --follow mode')
+  parser.add_argument('--lags',default=2048,type=int,help='Autocorrelation lags kept in --follow mode')
+  parser.add_argument('-n','--nprocs',default=0,type=int,help='Worker processes for several files (default: all CPUs)')
+  parser.add_argument('--summary',default=None,help="Write the summary table to this file ('-' for stdout), also for a single file")
+  parser.add_argument('--nocache',default=False,dest='nocache',action='store_true',help='Do not read or write the binary sidecar cache of the parsed file')
   # Parse the command-line arguments
   #args=parser.parse_args(sys.argv[1:])
   args=parser.parse_args()
@@ -254,44 +637,45 @@ if __name__ == "__main__":
   if args.col != None and args.observable != None:
     sys.stderr.write("\nError: Specify only column list OR observable list\n")
     sys.exit(1)
+  if args.follow and args.autowarmup:
+    sys.stderr.write("\nError: MSER-5 warmup detection needs the whole series; use a fixed --warmup with --follow\n")
+    sys.exit(1)
+
+  files = expandFiles(args.file)
+  batch = len(files) > 1 or args.summary != None
+  if args.follow:
+    if batch:
+      sys.stderr.write("\nError: --follow takes a single file\n")
+      sys.exit(1)
+    with open(files[0],'r') as f:
+      columns,labels = decideColumns(f, args.col, args.observable)
+      followFile(f, columns, labels, args.warmup, args.delimiter, args.interval, args.lags, args.quiet)
+    sys.exit(0)
+
+  options = dict(col=args.col, observable=args.observable, autowarmup=args.autowarmup, warmup=args.warmup, method=args.method,
+                 delimiter=args.delimiter, graphs=args.graphs, cache=not args.nocache)
+  if batch:
+    # Batch mode: files are analysed in worker processes, and the results gathered in one summary table
+    import multiprocessing
+    tasks = [(f,options) for f in files]
+    nprocs = min(args.nprocs if args.nprocs > 0 else multiprocessing.cpu_count(), len(files))
+    if nprocs > 1:
+      pool = multiprocessing.Pool(nprocs)
+      results = pool.imap(batchWorker, tasks)
+    else:
+      results = (batchWorker(t) for t in tasks)
+    out = sys.stdout if args.summary in (None,'-') else open(args.summary,'w')
+    writeSummary(out, results)
+    if nprocs > 1:
+      pool.close()
+      pool.join()
+    sys.exit(0)
 
-  # Initialize an empty list of means and errors
-  means=[]
-  errs=[]
-
-  # Loop through column records or observable names and do stats
-  if args.col != None:
-    for i in args.col:
-      if not args.quiet:
-        print "Processing column index {0}".format(i)
-      if args.autowarmup:
-          warmup,Data,nwarmup = autoWarmupMSER(args.file, i, delimiter=args.delimiter)
-          if not args.quiet:
-            print "Auto warmup detection with MSER-5 => ",nwarmup
-      else:
-          warmup,Data = extractData(args.file, i, args.warmup, delimiter=args.delimiter)
-      # Do the statistics - if command line, force stdout output
-      (nsamples,(min,max),mean,semcc,kappa,unbiasedvar,autocor)=doStats(warmup,Data,args.graphs,not args.quiet,'_{0}_col{1}'.format(args.file.name,i))
-      means.append(mean)
-      errs.append(semcc)
-  else:
-    for i in args.observable:
-      if not args.quiet:
-        print "Processing observable {0}".format(i)
-      column = decideColumn(args.file,i)
-      if args.autowarmup:
-          warmup,Data,nwarmup = autoWarmupMSER(args.file, column, delimiter=args.delimiter)
-          if not args.quiet:
-            print "Auto warmup detection with MSER-5 => ",nwarmup
-      else:
-          warmup,Data = extractData(args.file, column, args.warmup, delimiter=args.delimiter)
-      # Do the statistics - if command line, force stdout output
-      (nsamples,(min,max),mean,semcc,kappa,unbiasedvar,autocor)=doStats(warmup,Data,args.graphs,not args.quiet,'_{0}_{1}'.format(args.file.name,i))
-      means.append(mean)
-      errs.append(semcc)
+  # Single file - if command line, force stdout output
+  results = analyzeFile(files[0], verbose=not args.quiet, **options)
 
   if not args.quiet:
     sys.stdout.write("ALL MEANS +/- ERRS: ")
-  for i in range(len(means)):
-    sys.stdout.write("{0} {1} ".format(means[i],errs[i]))
+  for (label,mean,semcc,kappa,nwarmup,nsamples) in results:
+    sys.stdout.write("{0} {1} ".format(mean,semcc))
   sys.stdout.write("\n")